@@ -10,6 +10,7 @@ import sys
 import argparse
 import configparser
 import copy
+import time
 
 import reader
 import naive_bayes as nb
@@ -53,16 +54,136 @@ Main function
         naive_bayes.py will be used.
 
 """
+def sweep(args, train_set, train_labels, dev_set, dev_labels):
+    # Counts once, then evaluates every combination of the *_grid values (or the single
+    # value of a parameter without a grid) on the development set
+    model = nb.NaiveBayesModel(bigram=args.bigram).partial_fit(train_set, train_labels)
+    stats = nb.SweepStatistics(model, dev_set)
+    results = stats.evaluate(dev_labels, args.laplace_grid or [args.laplace], args.pos_prior_grid or [args.pos_prior],
+                             args.bigram_laplace_grid or [args.bigram_laplace],
+                             args.bigram_lambda_grid or [args.bigram_lambda])
+    print_grid(results, len(dev_labels))
+
+def cross_validate(args, train_set, train_labels):
+    # k-fold cross-validation of the same grid as sweep, on the training data
+    results = nb.crossValidate(train_set, train_labels, args.folds, args.workers,
+                               args.laplace_grid or [args.laplace], args.pos_prior_grid or [args.pos_prior],
+                               args.bigram, args.bigram_laplace_grid or [args.bigram_laplace],
+                               args.bigram_lambda_grid or [args.bigram_lambda])
+    print(f"{args.folds}-fold cross-validation")
+    print_grid(results, len(train_labels))
+
+# print every grid point, then the stats of the best one
+def print_grid(results, numvalues):
+    for laplace, bigram_laplace, bigram_lambda, pos_prior, accuracy, fp, fn, tp, tn in results:
+        print(f"laplace {laplace} bigram_laplace {bigram_laplace} bigram_lambda {bigram_lambda} pos_prior {pos_prior}: "
+              f"accuracy {accuracy} fp {fp} fn {fn} tp {tp} tn {tn}")
+    best = max(results, key=lambda r: r[4])
+    print(f"Best: laplace {best[0]} bigram_laplace {best[1]} bigram_lambda {best[2]} pos_prior {best[3]}")
+    print_stats(*best[4:], numvalues)
+
+def sketch_report(args, train_set, train_labels, dev_set, dev_labels):
+    # Dev accuracy of the bigram model with exact bigram counts and with count-min sketches
+    # of each --bigram_memory_grid size, next to the memory of the bigram counts
+    params = (args.laplace, args.pos_prior, True, args.bigram_laplace, args.bigram_lambda)
+    exact = nb.NaiveBayesModel(*params).partial_fit(train_set, train_labels, args.workers)
+    memory = nb.countBytes(exact.pos_pair_freq) + nb.countBytes(exact.neg_pair_freq)
+    accuracy = compute_accuracies(exact.predict(dev_set, args.engine, silently=True), dev_labels)[0]
+    print(f"exact: {len(exact.pos_pair_freq) + len(exact.neg_pair_freq)} bigram counts, {memory} bytes, accuracy {accuracy}")
+    for budget in args.bigram_memory_grid:
+        model = nb.NaiveBayesModel(*params, bigram_memory=budget).partial_fit(train_set, train_labels, args.workers)
+        memory = model.pos_pair_sketch.nbytes + model.neg_pair_sketch.nbytes
+        accuracy = compute_accuracies(model.predict(dev_set, args.engine, silently=True), dev_labels)[0]
+        print(f"sketch {model.pos_pair_sketch.depth} x {model.pos_pair_sketch.width}: {memory} bytes, accuracy {accuracy}")
+
+def prune_report(args, train_set, train_labels, dev_set, dev_labels):
+    # Table size, scoring throughput and dev accuracy of the model unpruned and pruned with
+    # each value of the --min_count_grid, --top_k_grid and --top_k_odds_grid options
+    model = nb.NaiveBayesModel(args.laplace, args.pos_prior, args.bigram, args.bigram_laplace, args.bigram_lambda)
+    model.partial_fit(train_set, train_labels, args.workers)
+    settings = [{}]
+    for option, grid in (('min_count', args.min_count_grid), ('top_k', args.top_k_grid), ('top_k_odds', args.top_k_odds_grid)):
+        settings += [{option: value} for value in grid or []]
+    for setting in settings:
+        model.prune(**setting)
+        model.prepare(args.engine, args.encoded)
+        tables = [table for table in model.tables() if table is not None]
+        entries = sum(len(table.pos) + len(table.neg) for table in tables)
+        nbytes = sum(nb.countBytes(table.pos) + nb.countBytes(table.neg) for table in tables)
+        start = time.perf_counter()
+        predicted_labels = model.predict(dev_set, args.engine, silently=True)
+        elapsed = time.perf_counter() - start
+        accuracy = compute_accuracies(predicted_labels, dev_labels)[0]
+        name = ", ".join(f"{option} {value}" for option, value in setting.items()) or "unpruned"
+        print(f"{name}: {entries} table entries, {nbytes} bytes, {len(dev_labels) / elapsed:.0f} docs/s, accuracy {accuracy}")
+
+def token_filter(args):
+    # The reader.TokenFilter of the --stop_words, --min_length and --drop_numeric options
+    if not (args.stop_words or args.min_length > 1 or args.drop_numeric):
+        return None
+    return reader.TokenFilter(reader.STOP_WORDS if args.stop_words else (), args.min_length, args.drop_numeric)
+
+def stream(args):
+    # Trains while reading the training files and scores while reading the development
+    # files, so memory is bounded by the model rather than the corpus
+    print(f"Streaming, stemming is {args.stemming}, lowercase is {args.lowercase}")
+    model = nb.NaiveBayesModel(args.laplace, args.pos_prior, args.bigram, args.bigram_laplace, args.bigram_lambda,
+                               args.bigram_memory)
+    model.fit_stream(reader.streamDataset(args.training_dir, args.stemming, args.lowercase, token_filter(args)))
+    dev_labels = []
+    def dev_docs():
+        for doc, label in reader.streamDataset(args.development_dir, args.stemming, args.lowercase, token_filter(args)):
+            dev_labels.append(label)
+            yield doc
+    predicted_labels = list(model.predict_stream(dev_docs(), args.engine))
+    accuracy, false_positive, false_negative, true_positive, true_negative = compute_accuracies(predicted_labels,dev_labels)
+    print_stats(accuracy, false_positive, false_negative, true_positive, true_negative, len(dev_labels))
+
 def main(args):
+    if args.stream:
+        stream(args)
+        return
 
-    train_set, train_labels, dev_set, dev_labels = nb.load_data(args.training_dir,args.development_dir,args.stemming,args.lowercase)
+    train_set, train_labels, dev_set, dev_labels = nb.load_data(args.training_dir,args.development_dir,args.stemming,args.lowercase,
+                                                              workers=args.workers,cache_dir=args.cache_dir,
+                                                              encoded=args.encoded,token_filter=token_filter(args),
+                                                              packed=args.packed,interned=args.interned)
     
-    if (args.bigram):
+    if args.folds:
+        cross_validate(args, train_set, train_labels)
+        return
+    if args.sweep:
+        sweep(args, train_set, train_labels, dev_set, dev_labels)
+        return
+    if args.prune_report:
+        prune_report(args, train_set, train_labels, dev_set, dev_labels)
+        return
+    if args.bigram_memory_grid:
+        sketch_report(args, train_set, train_labels, dev_set, dev_labels)
+        return
+    if args.load_model:
+        print(f"Scoring with saved model {args.load_model}")
+        predicted_labels = nb.loadModel(args.load_model).predict(dev_set, workers=args.workers)
+    elif args.save_model:
+        if args.bigram:
+            nb.print_paramter_vals_bigram(args.laplace, args.bigram_laplace, args.bigram_lambda, args.pos_prior)
+        else:
+            nb.print_paramter_vals(args.laplace, args.pos_prior)
+        model = nb.NaiveBayesModel(args.laplace, args.pos_prior, args.bigram, args.bigram_laplace, args.bigram_lambda,
+                                   args.bigram_memory)
+        model.partial_fit(train_set, train_labels, args.workers)
+        nb.saveModel(model, args.save_model, getattr(train_set, 'vocab', None))
+        predicted_labels = model.predict(dev_set, args.engine, workers=args.workers)
+    elif args.ngram_laplaces:
+        predicted_labels = nb.ngramBayes(train_set, train_labels, dev_set,
+                                         args.ngram_laplaces, args.ngram_lambdas, args.pos_prior)
+    elif (args.bigram):
         predicted_labels = nb.bigramBayes(train_set, train_labels, dev_set, 
-                                          args.laplace,args.bigram_laplace, args.bigram_lambda,args.pos_prior)
+                                          args.laplace,args.bigram_laplace, args.bigram_lambda,args.pos_prior,
+                                          engine=args.engine, workers=args.workers, bigram_memory=args.bigram_memory)
     else:
         predicted_labels = nb.naiveBayes(train_set, train_labels, dev_set,
-                                         args.laplace, args.pos_prior)
+                                         args.laplace, args.pos_prior, engine=args.engine, workers=args.workers)
 
     accuracy, false_positive, false_negative, true_positive, true_negative = compute_accuracies(predicted_labels,dev_labels)
     nn = len(dev_labels)
@@ -81,6 +202,12 @@ if __name__ == "__main__":
                         help='Use porter stemmer')
     parser.add_argument('--lowercase',dest="lowercase", type=bool, default=True,
                         help='Convert all word to lower case')
+    parser.add_argument('--stop_words',dest="stop_words", type=bool, default=False,
+                        help='Drop stop words while tokenizing')
+    parser.add_argument('--min_length',dest="min_length", type=int, default=1,
+                        help='Drop words shorter than this while tokenizing')
+    parser.add_argument('--drop_numeric',dest="drop_numeric", type=bool, default=False,
+                        help='Drop words made only of digits while tokenizing')
     parser.add_argument('--laplace',dest="laplace", type=float, default = 0.0004,   # 11
                         help='Laplace smoothing parameter')
     parser.add_argument('--bigram_laplace',dest="bigram_laplace", type=float, default = 0.00601,
@@ -89,8 +216,59 @@ if __name__ == "__main__":
                         help='Weight on bigrams vs. unigrams')
     parser.add_argument('--pos_prior',dest="pos_prior", type=float, default = 0.25,
                         help='Positive prior, i.e. percentage of test examples that are positive')
+    parser.add_argument('--ngram_laplaces',dest="ngram_laplaces", type=float, nargs='+', default=None,
+                        help='Use the n-gram mixture model with these Laplace constants for 1-grams, 2-grams, ... (n <= 4)')
+    parser.add_argument('--ngram_lambdas',dest="ngram_lambdas", type=float, nargs='+', default=None,
+                        help='Mixture weights of the n-gram orders, one per --ngram_laplaces value (equal weights if not given)')
+    parser.add_argument('--bigram_memory',dest="bigram_memory", type=int, default=None,
+                        help='Count bigrams approximately in count-min sketches of this many bytes (exact if not given)')
+    parser.add_argument('--workers',dest="workers", type=int, default = 1,
+                        help='Number of processes used to load the data, count the training set and score the development set')
+    parser.add_argument('--cache_dir',dest="cache_dir", type=str, default = None,
+                        help='Directory for the tokenized corpus cache (disabled if not given)')
+    parser.add_argument('--packed',dest="packed", type=bool, default=False,
+                        help='Read each data folder from one packed file, kept in --cache_dir or the temp folder (created on first use)')
+    parser.add_argument('--interned',dest="interned", type=bool, default=False,
+                        help='Share one string object per distinct word across the loaded documents')
+    parser.add_argument('--encoded',dest="encoded", type=bool, default=False,
+                        help='Keep the corpus as integer token ids instead of lists of strings')
+    parser.add_argument('--engine',dest="engine", type=str, default="loop", choices=["loop", "sparse", "logodds"],
+                        help='Score documents one at a time (loop), all at once with sparse matrices (sparse), '
+                             'or with a single log-odds table (logodds)')
+    parser.add_argument('--save_model',dest="save_model", type=str, default=None,
+                        help='Save the trained model to this file')
+    parser.add_argument('--load_model',dest="load_model", type=str, default=None,
+                        help='Score the development data with a saved model instead of training')
+    parser.add_argument('--sweep',dest="sweep", type=bool, default=False,
+                        help='Evaluate every combination of the --*_grid values instead of one setting')
+    parser.add_argument('--stream',dest="stream", type=bool, default=False,
+                        help='Train and score while reading the files instead of loading the data first')
+    parser.add_argument('--folds',dest="folds", type=int, default=0,
+                        help='Cross-validate the --*_grid values with this many folds of the training data '
+                             '(folds run on --workers processes)')
+    parser.add_argument('--laplace_grid',dest="laplace_grid", type=float, nargs='+', default=None)
+    parser.add_argument('--bigram_laplace_grid',dest="bigram_laplace_grid", type=float, nargs='+', default=None)
+    parser.add_argument('--bigram_lambda_grid',dest="bigram_lambda_grid", type=float, nargs='+', default=None)
+    parser.add_argument('--pos_prior_grid',dest="pos_prior_grid", type=float, nargs='+', default=None)
+    parser.add_argument('--prune_report',dest="prune_report", type=bool, default=False,
+                        help='Compare the size, speed and accuracy of the model pruned with each value of the '
+                             '--min_count_grid, --top_k_grid and --top_k_odds_grid options')
+    parser.add_argument('--min_count_grid',dest="min_count_grid", type=int, nargs='+', default=None)
+    parser.add_argument('--top_k_grid',dest="top_k_grid", type=int, nargs='+', default=None)
+    parser.add_argument('--top_k_odds_grid',dest="top_k_odds_grid", type=int, nargs='+', default=None)
+    parser.add_argument('--bigram_memory_grid',dest="bigram_memory_grid", type=int, nargs='+', default=None,
+                        help='Compare the accuracy and memory of exact bigram counts with sketches of these sizes')
 
     args = parser.parse_args()
+    if args.folds and args.folds < 2:
+        parser.error('--folds needs at least 2 folds')
+    if args.ngram_laplaces:
+        if len(args.ngram_laplaces) > 4:
+            parser.error('--ngram_laplaces takes 1 to 4 values')
+        if args.ngram_lambdas is None:
+            args.ngram_lambdas = [1 / len(args.ngram_laplaces)] * len(args.ngram_laplaces)
+        elif len(args.ngram_lambdas) != len(args.ngram_laplaces):
+            parser.error('--ngram_lambdas needs one value per --ngram_laplaces value')
     main(args)
 
 
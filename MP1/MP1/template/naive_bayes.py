@@ -7,8 +7,18 @@
 #
 # Created by Justin Lizama (jlizama2@illinois.edu) on 09/28/2018
 
+import gc
+import heapq
 import math
-from tqdm import tqdm
+import os
+import pickle
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice, repeat
+import numpy as np
 import reader
 """
 This is the main entry point for MP1. You should only modify code
@@ -23,10 +33,12 @@ You can modify the default values for stemming and lowercase, to improve perform
     we haven't passed in specific values for these parameters.
 """
 # False for all
-def load_data(trainingdir, testdir, stemming=False, lowercase=True, silently=False):
+def load_data(trainingdir, testdir, stemming=False, lowercase=True, silently=False, workers=1, cache_dir=None, encoded=False,
+              token_filter=None, packed=False, interned=False):
     print(f"Stemming is {stemming}")
     print(f"Lowercase is {lowercase}")
-    train_set, train_labels, dev_set, dev_labels = reader.load_dataset(trainingdir,testdir,stemming,lowercase,silently)
+    train_set, train_labels, dev_set, dev_labels = reader.load_dataset(trainingdir,testdir,stemming,lowercase,silently,workers,cache_dir,encoded,
+                                                                       token_filter,packed,interned)
     return train_set, train_labels, dev_set, dev_labels
 
 
@@ -40,7 +52,7 @@ You can modify the default values for the Laplace smoothing parameter and the pr
 Notice that we may pass in specific values for these parameters during our testing.
 """
 
-def naiveBayes(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8,silently=False):
+def naiveBayes(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8,silently=False,engine="loop",workers=1):
 
     """
     P(T | W) = P(W | T) * P(T) / P(W)
@@ -48,6 +60,7 @@ def naiveBayes(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8,si
     P(W | T) = P(W & T) / P(T)
     train_set: List of list of words
         Ex: [["This", "is", "a", "gem", "of", "words", ....], ["Of", "the", ...], ... ]
+        or a reader.EncodedCorpus (token ids), with dev_set encoded in the same Vocabulary
 
     train_labels: 1 or 0.
         1 = Good review
@@ -56,6 +69,12 @@ def naiveBayes(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8,si
     get word count: Count number of times that word shows up in good or bad review accordingly
     low accuracy: get rid of filler words (Stop words) + use stemming
 
+    engine: "loop" scores one document at a time, "sparse" scores the whole dev_set with
+        sparse matrix-vector products (see sparseScores), "logodds" thresholds the margins
+        of naiveBayesMargins
+    workers: number of processes counting the training set and scoring dev_set
+        (see mapReduceCounts and parallelPredict)
+
     """
     print_paramter_vals(laplace,pos_prior)
     # print("training set: ", train_set[0])
@@ -71,42 +90,868 @@ def naiveBayes(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8,si
     # filtered_train_set = remove_stop_words(train_set)
     # print("filted train set vs input train set: ", len(filtered_train_set), len(train_set))
 
-    pos_words_freq, neg_words_freq, total_pos_labels, total_neg_labels, total_pos_words, total_neg_words = word_count_dict(train_set, train_labels)
-    # pos_words_freq, neg_words_freq, total_pos_labels, total_neg_labels, total_pos_words, total_neg_words = word_count_dict(filtered_train_set, train_labels)
-    
+    model = NaiveBayesModel(laplace, pos_prior).partial_fit(train_set, train_labels, workers)
+    return model.predict(dev_set, engine, silently, workers)
+
+class NaiveBayesModel:
+    """
+    The unigram (and, with bigram=True, bigram) counts and totals of both classes, kept
+    so training can happen in pieces: partial_fit folds in more labeled documents, merge
+    adds the counts of a model trained on another shard, and predict / margins score
+    documents with the counts so far (naiveBayes, or bigramBayes when bigram=True).
+    Models that are merged or fed EncodedCorpus documents must share one Vocabulary.
+    With bigram_memory (bytes) the bigrams are counted approximately in a pair of
+    CountMinSketches of that total size instead of exact dictionaries. prune scores with
+    only part of the features.
+    """
+    def __init__(self, laplace=0.001, pos_prior=0.8, bigram=False, bigram_laplace=0.00601, bigram_lambda=.59,
+                 bigram_memory=None):
+        self.laplace = laplace
+        self.pos_prior = pos_prior
+        self.bigram = bigram
+        self.bigram_laplace = bigram_laplace
+        self.bigram_lambda = bigram_lambda
+        self.bigram_memory = bigram_memory
+        self.pos_words_freq, self.neg_words_freq = {}, {}
+        self.total_pos_labels, self.total_neg_labels = 0, 0
+        self.total_pos_words, self.total_neg_words = 0, 0
+        self.pos_pair_freq, self.neg_pair_freq = {}, {}
+        self.pos_total_pairs, self.neg_total_pairs = 0, 0
+        self.pruning = {}
+        self.pos_pair_sketch = self.neg_pair_sketch = None
+        if bigram and bigram_memory:
+            self.pos_pair_sketch = CountMinSketch.fromBudget(bigram_memory // 2)
+            self.neg_pair_sketch = CountMinSketch.fromBudget(bigram_memory // 2)
+        self._tables = None
+        self._odds = None
+
+    def partial_fit(self, docs, labels, workers=1):
+        # Adds the counts of more labeled documents; returns the model. With workers > 1
+        # the documents are counted map-reduce style by mapReduceCounts
+        if workers > 1:
+            return self.merge(mapReduceCounts(docs, labels, workers, self.bigram, self.bigram_memory))
+        pos, neg, pos_labels, neg_labels, pos_words, neg_words = word_count_dict(docs, labels)
+        addCounts(self.pos_words_freq, pos)
+        addCounts(self.neg_words_freq, neg)
+        self.total_pos_labels += pos_labels
+        self.total_neg_labels += neg_labels
+        self.total_pos_words += pos_words
+        self.total_neg_words += neg_words
+        if self.pos_pair_sketch is not None:
+            keys, indptr = hashedPairs(docs)
+            is_pos = np.repeat(np.asarray(labels) == 1, np.diff(indptr))
+            self.pos_pair_sketch.add(keys[is_pos])
+            self.neg_pair_sketch.add(keys[~is_pos])
+            self.pos_total_pairs += int(is_pos.sum())
+            self.neg_total_pairs += int(len(keys) - is_pos.sum())
+        elif self.bigram:
+            pos, neg, pos_pairs, neg_pairs = pair_count_dict(docs, labels)
+            addCounts(self.pos_pair_freq, pos)
+            addCounts(self.neg_pair_freq, neg)
+            self.pos_total_pairs += pos_pairs
+            self.neg_total_pairs += neg_pairs
+        self._tables = self._odds = None
+        return self
+
+    def fit_stream(self, pairs, batch_size=1000):
+        # Trains on an iterable of (doc, label) pairs such as reader.streamDataset,
+        # batch_size documents at a time, so memory is bounded by the model and one
+        # batch rather than the corpus; returns the model
+        for batch in batches(pairs, batch_size):
+            docs, labels = zip(*batch)
+            self.partial_fit(list(docs), list(labels))
+        return self
+
+    def predict_stream(self, docs, engine="loop", batch_size=1000):
+        return streamPredictions(self, docs, engine, batch_size)
+
+    def update(self, added, added_labels, removed=(), removed_labels=()):
+        # Applies a change set such as the train changes of reader.refresh_dataset: counts
+        # the added documents and takes out the counts of the removed ones; returns the model
+        if len(removed):
+            self.subtract(NaiveBayesModel(bigram=self.bigram, bigram_memory=self.bigram_memory)
+                          .partial_fit(removed, removed_labels))
+        return self.partial_fit(added, added_labels)
+
+    def checkFeatures(self, other):
+        # merge and subtract need the same features counted the same way: both exact,
+        # or both sketched in sketches of one shape
+        def shape(model):
+            sketch = model.pos_pair_sketch
+            return model.bigram, sketch is not None and (sketch.depth, sketch.width)
+        if shape(self) != shape(other):
+            raise ValueError("can only combine models with the same features and bigram_memory")
+
+    def merge(self, other):
+        # Adds the counts of another model (e.g. one trained on a different shard);
+        # returns this model
+        self.checkFeatures(other)
+        if self.pos_pair_sketch is not None:
+            self.pos_pair_sketch.merge(other.pos_pair_sketch)
+            self.neg_pair_sketch.merge(other.neg_pair_sketch)
+        addCounts(self.pos_words_freq, other.pos_words_freq)
+        addCounts(self.neg_words_freq, other.neg_words_freq)
+        self.total_pos_labels += other.total_pos_labels
+        self.total_neg_labels += other.total_neg_labels
+        self.total_pos_words += other.total_pos_words
+        self.total_neg_words += other.total_neg_words
+        addCounts(self.pos_pair_freq, other.pos_pair_freq)
+        addCounts(self.neg_pair_freq, other.neg_pair_freq)
+        self.pos_total_pairs += other.pos_total_pairs
+        self.neg_total_pairs += other.neg_total_pairs
+        self._tables = self._odds = None
+        return self
+
+    def subtract(self, other):
+        # Removes the counts of another model, e.g. one trained on documents to hold out
+        # of this one; returns this model. Features whose counts drop to zero are
+        # removed, so the result is exactly the model trained without those documents
+        self.checkFeatures(other)
+        if self.pos_pair_sketch is not None:
+            self.pos_pair_sketch.subtract(other.pos_pair_sketch)
+            self.neg_pair_sketch.subtract(other.neg_pair_sketch)
+        subtractCounts(self.pos_words_freq, other.pos_words_freq)
+        subtractCounts(self.neg_words_freq, other.neg_words_freq)
+        self.total_pos_labels -= other.total_pos_labels
+        self.total_neg_labels -= other.total_neg_labels
+        self.total_pos_words -= other.total_pos_words
+        self.total_neg_words -= other.total_neg_words
+        subtractCounts(self.pos_pair_freq, other.pos_pair_freq)
+        subtractCounts(self.neg_pair_freq, other.neg_pair_freq)
+        self.pos_total_pairs -= other.pos_total_pairs
+        self.neg_total_pairs -= other.neg_total_pairs
+        self._tables = self._odds = None
+        return self
 
-    # print(len(pos_words_freq), len(neg_words_freq))
-    # print(total_pos_labels, total_neg_labels, total_pos_words, total_neg_words)
+    def copy(self):
+        model = NaiveBayesModel(self.laplace, self.pos_prior, self.bigram, self.bigram_laplace, self.bigram_lambda,
+                                self.bigram_memory)
+        return model.merge(self).prune(**self.pruning)
 
+    def prune(self, min_count=None, top_k=None, top_k_odds=None):
+        # Scores with only the unigrams and bigrams LogProbTable.keep keeps; the counts
+        # stay, so training can go on and prune() undoes the pruning. Returns the model
+        self.pruning = {name: value for name, value in
+                        (('min_count', min_count), ('top_k', top_k), ('top_k_odds', top_k_odds)) if value is not None}
+        self._tables = self._odds = None
+        return self
+
+    def tables(self):
+        # The unigram and bigram (None without bigrams) LogProbTables of the current counts
+        if self._tables is None:
+            unigram_table = LogProbTable(self.pos_words_freq, self.neg_words_freq,
+                                         self.total_pos_words, self.total_neg_words, self.laplace)
+            if self.pruning:
+                keep = unigram_table.keep(self.pos_words_freq, self.neg_words_freq, **self.pruning)
+                unigram_table = LogProbTable(self.pos_words_freq, self.neg_words_freq,
+                                             self.total_pos_words, self.total_neg_words, self.laplace, keep)
+            bigram_table = None
+            if self.pos_pair_sketch is not None:
+                bigram_table = SketchTable(self.pos_pair_sketch, self.neg_pair_sketch,
+                                           self.pos_total_pairs, self.neg_total_pairs, self.bigram_laplace)
+            elif self.bigram:
+                bigram_table = LogProbTable(self.pos_pair_freq, self.neg_pair_freq,
+                                            self.pos_total_pairs, self.neg_total_pairs, self.bigram_laplace)
+                if self.pruning:
+                    keep = bigram_table.keep(self.pos_pair_freq, self.neg_pair_freq, **self.pruning)
+                    bigram_table = LogProbTable(self.pos_pair_freq, self.neg_pair_freq,
+                                                self.pos_total_pairs, self.neg_total_pairs, self.bigram_laplace, keep)
+            self._tables = unigram_table, bigram_table
+        return self._tables
+
+    def scores(self, docs, engine="loop", silently=False):
+        """
+        Unigram positive, unigram negative, bigram positive and bigram negative
+        log-likelihood arrays of docs (the bigram ones are None without bigrams)
+        """
+        unigram_table, bigram_table = self.tables()
+        if isinstance(bigram_table, SketchTable):
+            # the sketch scores every pair at once whatever the engine
+            unigram_pos, unigram_neg = self.unigramScores(docs, engine, silently)
+            return (unigram_pos, unigram_neg) + bigram_table.scores(docs)
+        if engine == "sparse":
+            unigram_pos, unigram_neg = sparseScores(unigram_table, docs)
+            if bigram_table is None:
+                return unigram_pos, unigram_neg, None, None
+            bigram_pos, bigram_neg = sparseScores(bigram_table, docs, bigram=True)
+            return unigram_pos, unigram_neg, bigram_pos, bigram_neg
+        if bigram_table is not None:
+            # one pass over each document for both models
+            return fusedScores(unigram_table, bigram_table, docs, silently)
+        return self.unigramScores(docs, engine, silently) + (None, None)
+
+    def unigramScores(self, docs, engine="loop", silently=False):
+        # The unigram positive and negative log-likelihood arrays of docs
+        unigram_table = self.tables()[0]
+        if engine == "sparse":
+            return sparseScores(unigram_table, docs)
+        unigram_pos, unigram_neg = np.empty(len(docs)), np.empty(len(docs))
+        for i, doc in enumerate(reader.progress(docs, disable=silently)): # for each review
+            unigram_pos[i], unigram_neg[i] = unigram_table.score(doc)
+        return unigram_pos, unigram_neg
+
+    def prepare(self, engine="loop", encoded=False):
+        # Builds the cached tables predict(engine) uses for EncodedCorpus (encoded=True)
+        # or list-of-words documents; returns the model
+        unigram_table, bigram_table = self.tables()
+        if engine == "logodds":
+            self.margins([], silently=True)
+        for table in (unigram_table, bigram_table):
+            if table is None or isinstance(table, SketchTable):
+                continue
+            if engine == "sparse":
+                table.columns()
+                if encoded:
+                    table.packedColumns()
+                else:
+                    table.wordColumns()
+            elif engine == "loop" and bigram_table is not None:
+                table.joint()
+        return self
+
+    def predict(self, docs, engine="loop", silently=False, workers=1):
+        # Returns the 1 (positive) / 0 (negative) label of each document; engine is
+        # "loop", "sparse" or "logodds" as in naiveBayes. With workers > 1 the
+        # documents are scored by parallelPredict
+        if workers > 1:
+            return parallelPredict(self, docs, engine, workers)
+        if engine == "logodds":
+            return [1 if m > 0 else 0 for m in self.margins(docs, silently)]
+        positive_posterior, negative_posterior = mixPosteriors(self, *self.scores(docs, engine, silently))
+        return (positive_posterior > negative_posterior).astype(int).tolist()
+
+    def margins(self, docs, silently=False):
+        """
+        Binary log-odds scoring: log P(pos | doc) - log P(neg | doc) of each document
+        (the bigram-mixed difference with bigrams). margin > 0 is the predict decision.
+        """
+        if self.pos_pair_sketch is not None:
+            positive_posterior, negative_posterior = mixPosteriors(self, *self.scores(docs, "sparse", silently))
+            return (positive_posterior - negative_posterior).tolist()
+        if self._odds is None:
+            unigram_table, bigram_table = self.tables()
+            self._odds = LogOddsTable(unigram_table), bigram_table and LogOddsTable(bigram_table)
+        unigram_odds, bigram_odds = self._odds
+        prior_log_odds = math.log(self.pos_prior) - math.log(1 - self.pos_prior)
+        if bigram_odds is None:
+            return [unigram_odds.margin(doc) + prior_log_odds for doc in reader.progress(docs, disable=silently)]
+        packed = isinstance(docs, reader.EncodedCorpus)
+        bigram_lambda = self.bigram_lambda
+        margins = []
+        for doc in reader.progress(docs, disable=silently):
+            unigram_margin = unigram_odds.margin(doc) + prior_log_odds
+            bigram_margin = bigram_odds.margin(pairFeatures(doc, packed)) + prior_log_odds
+            margins.append((1 - bigram_lambda) * unigram_margin + bigram_lambda * bigram_margin)
+        return margins
+
+def mixPosteriors(model, unigram_pos, unigram_neg, bigram_pos, bigram_neg):
+    # The positive and negative posterior arrays from the log-likelihoods of
+    # model.scores: log priors added, then mixed by bigram_lambda if there are bigrams
+    pos_log_prior, neg_log_prior = math.log(model.pos_prior), math.log(1 - model.pos_prior)
+    positive_posterior = unigram_pos + pos_log_prior
+    negative_posterior = unigram_neg + neg_log_prior
+    if model.bigram:
+        positive_posterior = (1 - model.bigram_lambda) * positive_posterior + model.bigram_lambda * (bigram_pos + pos_log_prior)
+        negative_posterior = (1 - model.bigram_lambda) * negative_posterior + model.bigram_lambda * (bigram_neg + neg_log_prior)
+    return positive_posterior, negative_posterior
+
+MODEL_MAGIC = b'MP1NB001'
+# magic, has bigrams, laplace, pos_prior, bigram_laplace, bigram_lambda, total_pos_labels,
+# total_neg_labels, total_pos_words, total_neg_words, pos_total_pairs, neg_total_pairs,
+# vocabulary size V, number of bigrams P, vocabulary bytes
+MODEL_HEADER = struct.Struct('<8sQ4d9q')
+
+def saveModel(model, path, vocab=None):
+    """
+    Writes a NaiveBayesModel in a flat little-endian layout that loadModel can mmap:
+    the header, then the 8-byte sections
+        unigram pos/neg counts          int64[V] x 2    (indexed by word id)
+        unigram pos/neg log P(w | C)    float64[V + 1] x 2 (last entry is UNK)
+        bigram keys                     int64[P]        sorted (word1 << 32) | word2
+        bigram pos/neg counts           int64[P] x 2
+        bigram pos/neg log P(p | C)     float64[P + 1] x 2 (last entry is UNK)
+    and finally the '\n'-joined vocabulary. vocab is the Vocabulary of the EncodedCorpus
+    the model was trained on, or None for a model trained on lists of words.
+    Models with sketched bigram counts can't be saved.
+    """
+    if model.pos_pair_sketch is not None:
+        raise ValueError("saveModel needs exact bigram counts, not a bigram_memory sketch")
+    unigram_table, bigram_table = model.tables()
+    if vocab is None:
+        vocab = reader.Vocabulary()
+        for word in list(model.pos_words_freq) + list(model.neg_words_freq):
+            vocab.add(word)
+        word_id = vocab.ids.__getitem__
+        pair_id = lambda pair: (word_id(pair[0]) << 32) | word_id(pair[1])
+    else:
+        word_id = pair_id = int
+    V = len(vocab)
 
-    V_pos = len(pos_words_freq)
-    V_neg = len(neg_words_freq)
-    yhats = []
-    for doc in tqdm(dev_set, disable=silently): # for each review
+    def idArrays(freq, table_probs, unk, key_id, size):
+        ids = np.fromiter(map(key_id, freq), dtype=np.int64, count=len(freq))
+        counts = np.zeros(size, dtype='<i8')
+        counts[ids] = np.fromiter(freq.values(), dtype=np.int64, count=len(freq))
+        probs = np.full(size + 1, unk, dtype='<f8')
+        # every feature of the (maybe pruned) table; the rest, pruned or unseen, are UNK
+        features = list(table_probs)
+        probs[np.fromiter(map(key_id, features), dtype=np.int64, count=len(features))] = [table_probs[f] for f in features]
+        return counts, probs
+
+    sections = []
+    for freq, probs, unk in ((model.pos_words_freq, unigram_table.pos, unigram_table.pos_unk),
+                             (model.neg_words_freq, unigram_table.neg, unigram_table.neg_unk)):
+        sections.append(idArrays(freq, probs, unk, word_id, V))
+    sections = [sections[0][0], sections[1][0], sections[0][1], sections[1][1]]
+
+    P = 0
+    if bigram_table is not None:
+        pairs = list(model.pos_pair_freq) + [p for p in model.neg_pair_freq if p not in model.pos_pair_freq]
+        keys = np.fromiter(map(pair_id, pairs), dtype=np.int64, count=len(pairs))
+        order = np.argsort(keys)
+        pairs = [pairs[i] for i in order]
+        P = len(pairs)
+        sections.append(keys[order].astype('<i8'))
+        for freq in (model.pos_pair_freq, model.neg_pair_freq):
+            sections.append(np.array([freq.get(p, 0) for p in pairs], dtype='<i8'))
+        for probs, unk in ((bigram_table.pos, bigram_table.pos_unk), (bigram_table.neg, bigram_table.neg_unk)):
+            sections.append(np.array([probs.get(p, unk) for p in pairs] + [unk], dtype='<f8'))
+    else:
+        # empty bigram sections, so the layout is the same with and without bigrams
+        sections += [np.zeros(0, dtype='<i8')] * 3 + [np.zeros(1, dtype='<f8')] * 2
+
+    words = '\n'.join(vocab.words).encode()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MODEL_HEADER.pack(MODEL_MAGIC, int(model.bigram), model.laplace, model.pos_prior,
+                                  model.bigram_laplace, model.bigram_lambda,
+                                  model.total_pos_labels, model.total_neg_labels,
+                                  model.total_pos_words, model.total_neg_words,
+                                  model.pos_total_pairs, model.neg_total_pairs, V, P, len(words)))
+        for section in sections:
+            f.write(section.tobytes())
+        f.write(words)
+    os.replace(tmp, path)
+
+def loadModel(path):
+    # Maps a file written by saveModel; see MappedModel
+    return MappedModel(path)
+
+class MappedModel:
+    """
+    A model saved by saveModel, memory-mapped read-only: the count and log-probability
+    arrays are views of the file, so opening it costs no parsing and processes scoring
+    with the same file share its pages. Scores documents with sparse matrix-vector
+    products like the "sparse" engine, and gives the same predictions as the saved model.
+    """
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self.data) < MODEL_HEADER.size or bytes(self.data[:len(MODEL_MAGIC)]) != MODEL_MAGIC:
+            raise ValueError(f"{path} is not a saved naive Bayes model")
+        (magic, bigram, self.laplace, self.pos_prior, self.bigram_laplace, self.bigram_lambda,
+         self.total_pos_labels, self.total_neg_labels, self.total_pos_words, self.total_neg_words,
+         self.pos_total_pairs, self.neg_total_pairs, V, P, num_bytes) = MODEL_HEADER.unpack(bytes(self.data[:MODEL_HEADER.size]))
+        self.bigram = bool(bigram)
+        self._offset = MODEL_HEADER.size
+        self.pos_words, self.neg_words = self._section('<i8', V), self._section('<i8', V)
+        self.pos_word_probs, self.neg_word_probs = self._section('<f8', V + 1), self._section('<f8', V + 1)
+        self.pair_keys = self._section('<i8', P)
+        self.pos_pairs, self.neg_pairs = self._section('<i8', P), self._section('<i8', P)
+        self.pos_pair_probs, self.neg_pair_probs = self._section('<f8', P + 1), self._section('<f8', P + 1)
+        self._words = self.data[self._offset:self._offset + num_bytes]
+        self._vocab = None
+
+    def _section(self, dtype, n):
+        start = self._offset
+        self._offset += 8 * n
+        return self.data[start:self._offset].view(dtype)
+
+    def vocab(self):
+        # The model's Vocabulary, decoded on first use (only needed to encode new text)
+        if self._vocab is None:
+            words = bytes(self._words).decode()
+            self._vocab = reader.Vocabulary(words.split('\n') if words else ())
+        return self._vocab
+
+    def modelIds(self, docs):
+        # The int64 token ids of docs in the model's vocabulary (V for unknown words)
+        # and their document offsets
+        V = len(self.pos_words)
+        if not isinstance(docs, reader.EncodedCorpus):
+            corpus = reader.EncodedCorpus()
+            corpus.extend(docs)
+            docs = corpus
+        ids = self.vocab().ids
+        translate = np.array([ids.get(w, V) for w in docs.vocab.words] + [V], dtype=np.int64)
+        tokens = translate[np.frombuffer(docs.tokens, dtype=np.uint32)]
+        offsets = np.frombuffer(docs.offsets, dtype=np.uint32).astype(np.int64)
+        return tokens, offsets
+
+    def scores(self, docs, engine="sparse", silently=False):
+        # Same arrays as NaiveBayesModel.scores, always computed with sparse products
+        import scipy.sparse
+        tokens, offsets = self.modelIds(docs)
+        X = scipy.sparse.csr_matrix((np.ones(len(tokens)), tokens, offsets),
+                                    shape=(len(offsets) - 1, len(self.pos_word_probs)))
+        unigram_pos, unigram_neg = X @ self.pos_word_probs, X @ self.neg_word_probs
+        if not self.bigram:
+            return unigram_pos, unigram_neg, None, None
+        keys, indptr = pairKeys(tokens, offsets)
+        X = scipy.sparse.csr_matrix((np.ones(len(keys)), searchKeys(self.pair_keys, keys), indptr),
+                                    shape=(len(indptr) - 1, len(self.pos_pair_probs)))
+        return unigram_pos, unigram_neg, X @ self.pos_pair_probs, X @ self.neg_pair_probs
+
+    def prepare(self, engine="sparse", encoded=False):
+        # Decodes the vocabulary, so scoring workers forked afterwards inherit it
+        self.vocab()
+        return self
+
+    def predict(self, docs, engine="sparse", silently=False, workers=1):
+        if workers > 1:
+            return parallelPredict(self, docs, engine, workers)
+        positive_posterior, negative_posterior = mixPosteriors(self, *self.scores(docs))
+        return (positive_posterior > negative_posterior).astype(int).tolist()
+
+    def predict_stream(self, docs, engine="sparse", batch_size=1000):
+        return streamPredictions(self, docs, engine, batch_size)
+
+    def margins(self, docs, silently=False):
+        positive_posterior, negative_posterior = mixPosteriors(self, *self.scores(docs))
+        return (positive_posterior - negative_posterior).tolist()
+
+def batches(items, size):
+    # Yields the items of an iterable in lists of up to size
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+def streamPredictions(model, docs, engine="loop", batch_size=1000):
+    # Yields the prediction of each document of an iterable (e.g. the words of
+    # reader.streamDir), scoring batch_size documents at a time
+    for batch in batches(docs, batch_size):
+        yield from model.predict(batch, engine, silently=True)
+
+def addCounts(counts, more):
+    # Adds the counts of the dict more into the dict counts
+    for key, count in more.items():
+        counts[key] = counts.get(key, 0) + count
+
+def subtractCounts(counts, less):
+    # Takes the counts of the dict less out of the dict counts, dropping zero counts
+    for key, count in less.items():
+        left = counts[key] - count
+        if left:
+            counts[key] = left
+        else:
+            del counts[key]
+
+class LogProbTable:
+    """
+    Laplace-smoothed log P(feature | class) for both classes, computed once from the
+    counts of word_count_dict (or pair_count_dict) so scoring is only lookups and sums.
+    Features never seen in a class get that class's log P(UNK | C).
+    With keep (a set, see LogProbTable.keep) the table is pruned: only the kept features
+    are in it, and the counts of all the others are folded into UNK, which scores every
+    feature outside keep. Each class's vocabulary size is still the number of features
+    it saw, now among the kept ones, and a kept feature the class never saw gets the
+    unpruned log P(UNK | C), so pruning nothing gives back the unpruned table.
+    """
+    def __init__(self, pos_freq, neg_freq, total_pos, total_neg, laplace, keep=None):
+        if keep is None:
+            pos_denom = total_pos + laplace * (len(pos_freq) + 1)
+            neg_denom = total_neg + laplace * (len(neg_freq) + 1)
+            self.pos_unk = math.log(laplace / pos_denom)
+            self.neg_unk = math.log(laplace / neg_denom)
+        else:
+            pos_freq = {f: pos_freq[f] for f in keep if f in pos_freq}
+            neg_freq = {f: neg_freq[f] for f in keep if f in neg_freq}
+            pos_denom = total_pos + laplace * (len(pos_freq) + 1)
+            neg_denom = total_neg + laplace * (len(neg_freq) + 1)
+            self.pos_unk = math.log((total_pos - sum(pos_freq.values()) + laplace) / pos_denom)
+            self.neg_unk = math.log((total_neg - sum(neg_freq.values()) + laplace) / neg_denom)
+        self.pos = {w: math.log((count + laplace) / pos_denom) for w, count in pos_freq.items()}
+        self.neg = {w: math.log((count + laplace) / neg_denom) for w, count in neg_freq.items()}
+        if keep is not None:
+            # kept features one class never saw must not fall through to the folded UNK
+            # (when anything was folded into it at all)
+            pos_unseen, neg_unseen = math.log(laplace / pos_denom), math.log(laplace / neg_denom)
+            for table, unseen, unk in ((self.pos, pos_unseen, self.pos_unk), (self.neg, neg_unseen, self.neg_unk)):
+                if unk != unseen:
+                    for f in keep:
+                        if f not in table:
+                            table[f] = unseen
+        self._columns = None
+        self._packed = None
+        self._words = None
+        self._joint = None
+
+    def keep(self, pos_freq, neg_freq, min_count=None, top_k=None, top_k_odds=None):
+        """
+        The features that survive pruning: those seen at least min_count times in both
+        classes together, then the top_k most frequent, then the top_k_odds with the
+        largest |log P(f | pos) - log P(f | neg)| in this table. pos_freq and neg_freq are
+        the counts the table was built from.
+        """
+        counts = dict(pos_freq)
+        for f, count in neg_freq.items():
+            counts[f] = counts.get(f, 0) + count
+        keep = counts.keys()
+        if min_count is not None:
+            keep = [f for f in keep if counts[f] >= min_count]
+        if top_k is not None:
+            keep = heapq.nlargest(top_k, keep, key=counts.__getitem__)
+        if top_k_odds is not None:
+            pos, neg = self.pos.get, self.neg.get
+            keep = heapq.nlargest(top_k_odds, keep, key=lambda f: abs(pos(f, self.pos_unk) - neg(f, self.neg_unk)))
+        return set(keep)
+
+    def score(self, features):
+        # Returns the (positive, negative) log-likelihood sums of the features
+        pos, neg = self.pos.get, self.neg.get
+        pos_unk, neg_unk = self.pos_unk, self.neg_unk
         pos_prob_post = 0
         neg_prob_post = 0
-        for word in doc:
-            if word in pos_words_freq:
-                pos_word_log_prob = math.log((pos_words_freq[word] + laplace) / (total_pos_words + laplace * (V_pos + 1)))
-            else:
-                pos_word_log_prob = math.log(laplace / (total_pos_words + laplace * (V_pos + 1)))  # P(UNK | C)
-            pos_prob_post += pos_word_log_prob
+        for w in features:
+            pos_prob_post += pos(w, pos_unk)
+            neg_prob_post += neg(w, neg_unk)
+        return pos_prob_post, neg_prob_post
+
+    def columns(self):
+        # Every feature seen in training in a fixed column order, the {feature: column}
+        # index, and the positive and negative log-probability vectors by column; the
+        # extra last column is UNK. Built on first use and kept, so repeated batches only
+        # pay for the column lookups and the products
+        if self._columns is None:
+            features = list(self.pos) + [f for f in self.neg if f not in self.pos]
+            index = {f: i for i, f in enumerate(features)}
+            pos_weights = np.array([self.pos.get(f, self.pos_unk) for f in features] + [self.pos_unk])
+            neg_weights = np.array([self.neg.get(f, self.neg_unk) for f in features] + [self.neg_unk])
+            self._columns = features, index, pos_weights, neg_weights
+        return self._columns
 
-            if word in neg_words_freq:
-                neg_word_log_prob = math.log((neg_words_freq[word] + laplace) / (total_neg_words + laplace * (V_neg + 1)))
+    def joint(self):
+        # {feature: (log P(f | pos), log P(f | neg))} over every seen feature and the
+        # (pos, neg) UNK pair, so one lookup serves both classes; built on first use
+        if self._joint is None:
+            neg = self.neg.get
+            joint = {f: (p, neg(f, self.neg_unk)) for f, p in self.pos.items()}
+            for f, n in self.neg.items():
+                if f not in joint:
+                    joint[f] = (self.pos_unk, n)
+            self._joint = joint, (self.pos_unk, self.neg_unk)
+        return self._joint
+
+    def packedColumns(self):
+        # The features as sorted int64 keys (token ids, or packed pair keys from
+        # pair_count_dict on an EncodedCorpus) and the column of each sorted key,
+        # for matching an EncodedCorpus with NumPy
+        if self._packed is None:
+            keys = np.array(self.columns()[0], dtype=np.int64)
+            order = np.argsort(keys)
+            self._packed = keys[order], order
+        return self._packed
+
+    def wordColumns(self):
+        # packedColumns for lists of words: a {word: id} index of the words in the
+        # features (the unigrams, or both words of the (word1, word2) pairs), the
+        # features as sorted int64 keys in those ids (packed (id1 << 32) | id2 for
+        # pairs) and the column of each sorted key; built on first use
+        if self._words is None:
+            features = self.columns()[0]
+            words = {}
+            if features and isinstance(features[0], tuple):
+                keys = [(words.setdefault(w1, len(words)) << 32) | words.setdefault(w2, len(words))
+                        for w1, w2 in features]
             else:
-                neg_word_log_prob = math.log(laplace / (total_neg_words + laplace * (V_neg + 1)))
-            neg_prob_post += neg_word_log_prob
-        
-        pos_prob_post += math.log(pos_prior)
-        neg_prob_post += math.log(1 - pos_prior)
-
-        if pos_prob_post > neg_prob_post:
-            yhats.append(1)
-        else:
-            yhats.append(0)
+                keys = [words.setdefault(w, len(words)) for w in features]
+            keys = np.array(keys, dtype=np.int64)
+            order = np.argsort(keys)
+            self._words = words, keys[order], order
+        return self._words
+
+class HyperLogLog:
+    """
+    Estimated number of distinct int64 keys in 2**precision one-byte registers: each key
+    is hashed (splitmix64), the top precision bits pick a register and the register keeps
+    the largest rank (leading zeros + 1) of the remaining bits seen. The estimate doesn't
+    saturate like linear counting, and two counters are merged register by register.
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        return self.registers.nbytes
+
+    def add(self, keys):
+        # Counts each of keys once, whatever the number of repeats
+        h = np.asarray(keys).astype(np.uint64)
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h = h ^ (h >> np.uint64(31))
+        index = (h >> np.uint64(64 - self.precision)).astype(np.intp)
+        # the next 52 bits, exact as float64, so frexp gives their bit length
+        rest = ((h << np.uint64(self.precision)) >> np.uint64(12)).astype(np.float64)
+        ranks = (53 - np.frexp(rest)[1]).astype(np.uint8)
+        np.maximum.at(self.registers, index, ranks)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        empty = m - np.count_nonzero(self.registers)
+        if estimate <= 2.5 * m and empty:
+            # small range: linear counting on the registers is the better estimate
+            return m * math.log(m / empty)
+        return estimate
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+class CountMinSketch:
+    """
+    Approximate counts of int64 keys (packed pair keys) in depth rows of width uint32
+    counters, width a power of two. Each row hashes a key to one of its counters with
+    its own multiply-shift hash, and a key's count is the smallest of its depth counters,
+    so counts are never underestimated; floor() is what a key never counted gets from
+    collisions alone. Sketches with the same shape use the same hashes and can be merged
+    or subtracted counter by counter. The number of distinct keys is kept alongside in a
+    HyperLogLog.
+    """
+    def __init__(self, width, depth=4):
+        assert width >= 2 and width & (width - 1) == 0, "width must be a power of two"
+        self.width, self.depth = width, depth
+        self.shift = np.uint64(64 - width.bit_length() + 1)
+        # fixed seed: every sketch hashes the same way
+        multipliers = np.random.default_rng(0).integers(0, 2**63, depth, dtype=np.uint64)
+        self.multipliers = (multipliers << np.uint64(1)) | np.uint64(1)
+        self.counts = np.zeros((depth, width), dtype=np.uint32)
+        self.keys = HyperLogLog()
+
+    @classmethod
+    def fromBudget(cls, nbytes, depth=4):
+        # The widest sketch whose counters and distinct-key registers fit in nbytes
+        width = 2
+        while 2 * width * depth * 4 + HyperLogLog().nbytes <= nbytes:
+            width *= 2
+        return cls(width, depth)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.keys.nbytes
+
+    def buckets(self, keys):
+        # (depth x len(keys)) counter index of each key in each row
+        return ((np.asarray(keys).astype(np.uint64) * self.multipliers[:, None]) >> self.shift).astype(np.intp)
+
+    def add(self, keys):
+        # Counts one occurrence of each of keys
+        for row, buckets in zip(self.counts, self.buckets(keys)):
+            row += np.bincount(buckets, minlength=self.width).astype(np.uint32)
+        self.keys.add(keys)
 
-    return yhats
+    def query(self, keys):
+        # The estimated count of each of keys
+        return self.counts[np.arange(self.depth)[:, None], self.buckets(keys)].min(axis=0)
+
+    def floor(self):
+        """
+        The expected query() of a key never counted: the smallest of one random counter
+        per row, E[min] = sum over t >= 1 of prod over rows of P(counter >= t), summed
+        between the distinct counter values where the product changes
+        """
+        rows = np.sort(self.counts, axis=1)
+        values = np.unique(rows)
+        values = values[values > 0]
+        if len(values) == 0:
+            return 0.0
+        at_least = np.ones(len(values))
+        for row in rows:
+            at_least *= (self.width - np.searchsorted(row, values)) / self.width
+        return float(np.diff(values, prepend=0).astype(np.float64) @ at_least)
+
+    def distinct(self):
+        # Estimated number of distinct keys counted
+        return self.keys.estimate()
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.keys.merge(other.keys)
+        return self
+
+    def subtract(self, other):
+        # The distinct-key registers can't forget keys, so keys only the subtracted
+        # sketch counted are still in distinct()
+        self.counts -= other.counts
+        return self
+
+def countBytes(freq):
+    # Approximate memory of a count dictionary: the table, its tuple or int keys and the
+    # counts (the words inside pair tuples are shared with the unigram counts)
+    return sys.getsizeof(freq) + sum(sys.getsizeof(key) + sys.getsizeof(count) for key, count in freq.items())
+
+class SketchTable:
+    """
+    The LogProbTable of bigrams counted in CountMinSketches: log P(pair | C) is computed
+    from each pair's estimated count when scoring, with the number of distinct pairs in
+    the Laplace denominator estimated by the sketch's HyperLogLog. The class whose sketch
+    is more crowded would give unseen pairs more collision probability than the other,
+    so both classes' counts are raised to the same noise floor, the larger of the two
+    floor() / denominator probabilities, and an unseen pair scores alike in both.
+    """
+    def __init__(self, pos_sketch, neg_sketch, total_pos, total_neg, laplace):
+        self.pos_sketch, self.neg_sketch = pos_sketch, neg_sketch
+        self.pos_denom = total_pos + laplace * (pos_sketch.distinct() + 1)
+        self.neg_denom = total_neg + laplace * (neg_sketch.distinct() + 1)
+        noise = max(pos_sketch.floor() / self.pos_denom, neg_sketch.floor() / self.neg_denom)
+        self.pos_smoothing = laplace + noise * self.pos_denom
+        self.neg_smoothing = laplace + noise * self.neg_denom
+
+    def scores(self, docs):
+        # The positive and negative bigram log-likelihood arrays of docs
+        keys, indptr = hashedPairs(docs)
+        pos = np.log((self.pos_sketch.query(keys) + self.pos_smoothing) / self.pos_denom)
+        neg = np.log((self.neg_sketch.query(keys) + self.neg_smoothing) / self.neg_denom)
+        # per-document sums from the running totals at the row pointers
+        pos = np.concatenate(([0], np.cumsum(pos)))
+        neg = np.concatenate(([0], np.cumsum(neg)))
+        return pos[indptr[1:]] - pos[indptr[:-1]], neg[indptr[1:]] - neg[indptr[:-1]]
+
+class LogOddsTable:
+    """
+    log P(f | pos) - log P(f | neg) for every feature of a LogProbTable, plus the UNK
+    log-odds, so the binary decision costs one lookup and one addition per feature
+    """
+    def __init__(self, table):
+        neg = table.neg.get
+        self.odds = {f: p - neg(f, table.neg_unk) for f, p in table.pos.items()}
+        for f, n in table.neg.items():
+            if f not in self.odds:
+                self.odds[f] = table.pos_unk - n
+        self.unk = table.pos_unk - table.neg_unk
+
+    def margin(self, features):
+        # Returns the summed log-odds of the features
+        odds, unk = self.odds.get, self.unk
+        margin = 0
+        for f in features:
+            margin += odds(f, unk)
+        return margin
+
+def naiveBayesMargins(train_set, train_labels, dev_set, laplace=0.001, pos_prior=0.8, silently=False):
+    """
+    Binary log-odds scoring: returns log P(pos | doc) - log P(neg | doc) for each document
+    of dev_set. A document is positive when its margin is > 0, the same decision naiveBayes
+    makes; callers can also pick their own threshold.
+    """
+    model = NaiveBayesModel(laplace, pos_prior).partial_fit(train_set, train_labels)
+    return model.margins(dev_set, silently)
+
+def pairFeatures(doc, packed=False):
+    # The bigram features of one document: (word1, word2) tuples, or for the token-id
+    # documents of an EncodedCorpus the packed keys (word1 << 32) | word2
+    if packed:
+        return [(word1 << 32) | word2 for word1, word2 in zip(doc, doc[1:])]
+    return zip(doc, doc[1:])
+
+def packedPairs(corpus):
+    """
+    The packed bigram keys (word1 << 32) | word2 of every document of an EncodedCorpus as
+    one int64 array, and the CSR row pointers giving the pairs of each document
+    """
+    tokens = np.frombuffer(corpus.tokens, dtype=np.uint32).astype(np.int64)
+    offsets = np.frombuffer(corpus.offsets, dtype=np.uint32).astype(np.int64)
+    return pairKeys(tokens, offsets)
+
+def pairKeys(tokens, offsets):
+    # packedPairs on int64 token-id and document-offset arrays
+    keys = (tokens[:-1] << 32) | tokens[1:]
+    # drop the pairs that run across a document boundary
+    keep = np.ones(len(keys), dtype=bool)
+    starts = offsets[1:-1]
+    keep[starts[(starts > 0) & (starts <= len(keys))] - 1] = False
+    indptr = np.concatenate(([0], np.cumsum(np.maximum(np.diff(offsets) - 1, 0))))
+    return keys[keep], indptr
+
+def hashedPairs(docs):
+    """
+    packedPairs for any documents: an EncodedCorpus packs its token ids, lists of words
+    pack the CRC-32 of each word (stable across processes, unlike hash())
+    """
+    if isinstance(docs, reader.EncodedCorpus):
+        return packedPairs(docs)
+    crcs = {}
+    tokens, offsets = [], [0]
+    for doc in docs:
+        for word in doc:
+            crc = crcs.get(word)
+            if crc is None:
+                crc = crcs[word] = zlib.crc32(word.encode())
+            tokens.append(crc)
+        offsets.append(len(tokens))
+    return pairKeys(np.array(tokens, dtype=np.int64), np.array(offsets, dtype=np.int64))
+
+def searchKeys(sorted_keys, keys):
+    """
+    Position of each of keys in the sorted int64 array sorted_keys, or len(sorted_keys)
+    for the keys it doesn't contain
+    """
+    # search once per distinct key (sorted needles are much faster to look up)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    found = np.searchsorted(sorted_keys, unique_keys)
+    hit = found < len(sorted_keys)
+    hit[hit] = sorted_keys[found[hit]] == unique_keys[hit]
+    found[~hit] = len(sorted_keys)
+    return found[inverse]
+
+def encodedColumns(table, dev_set, bigram=False):
+    """
+    Column indices and CSR row pointers of an EncodedCorpus, computed with NumPy on the
+    token array: unigrams are the token ids and bigrams the packed pair keys, looked up
+    in the table's sorted keys. Unmatched features map to the UNK column.
+    """
+    if bigram:
+        keys, indptr = packedPairs(dev_set)
+    else:
+        keys = np.frombuffer(dev_set.tokens, dtype=np.uint32).astype(np.int64)
+        indptr = np.frombuffer(dev_set.offsets, dtype=np.uint32).astype(np.int64)
+    train_keys, order = table.packedColumns()
+    return np.append(order, len(order))[searchKeys(train_keys, keys)], indptr
+
+def wordColumns(table, dev_set, bigram=False):
+    """
+    encodedColumns for lists of words: each token becomes its id in the table's
+    wordColumns index (one C-level dict lookup per token, words outside it an id no key
+    uses), then pairs are packed and matched with NumPy like an EncodedCorpus
+    """
+    words, train_keys, order = table.wordColumns()
+    lengths = [len(doc) for doc in dev_set]
+    tokens = chain.from_iterable(dev_set)
+    ids = np.fromiter(map(words.get, tokens, repeat(len(words))), dtype=np.int64, count=sum(lengths))
+    indptr = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    if not bigram:
+        return ids, indptr  # a unigram's id is its column, and unknown words get UNK's
+    keys, indptr = pairKeys(ids, indptr)
+    return np.append(order, len(order))[searchKeys(train_keys, keys)], indptr
+
+def sparseScores(table, dev_set, bigram=False):
+    """
+    Scores all of dev_set at once with a LogProbTable: builds the CSR document-feature count
+    matrix X and returns the positive and negative log-likelihood vectors X @ log P(f | C),
+    one sparse matrix-vector product per class. bigram=True scores adjacent word pairs.
+    """
+    import scipy.sparse
+    features, index, pos_weights, neg_weights = table.columns()
+    unk = len(features)
+    if isinstance(dev_set, reader.EncodedCorpus):
+        cols, indptr = encodedColumns(table, dev_set, bigram)
+    else:
+        cols, indptr = wordColumns(table, dev_set, bigram)
+    X = scipy.sparse.csr_matrix((np.ones(len(cols)), cols, indptr), shape=(len(indptr) - 1, unk + 1))
+    return X @ pos_weights, X @ neg_weights
 
 def word_count_dict(train_set, train_labels):  # P(Word | Type)
     """
@@ -142,15 +987,9 @@ def word_count_dict(train_set, train_labels):  # P(Word | Type)
 
 
 def remove_stop_words(train_set):
-    stop_words = ["i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your", "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "her", "hers", "herself", "it", "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who", "whom", "this", "that", "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an", "the", "and", "but", "if", "or", "because", "as", "until", "while", "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during", "before", "after", "above", "below", "to", "from", "up", "down", "in", "out", "on", "off", "over", "under", "again", "further", "then", "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few", "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s", "t", "can", "will", "just", "don", "should", "now"]
-    filtered_train_set = []
-    for word_list in train_set:
-        sub_list = []
-        for w in word_list:
-            if w not in stop_words:
-                sub_list.append(w)
-        filtered_train_set.append(sub_list)
-    return filtered_train_set
+    # Prefer reader.TokenFilter, which drops stop words while the files are read
+    stop_words = reader.STOP_WORDS
+    return [[w for w in word_list if w not in stop_words] for word_list in train_set]
 
 def print_paramter_vals_bigram(unigram_laplace,bigram_laplace,bigram_lambda,pos_prior):
     print(f"Unigram Laplace {unigram_laplace}")
@@ -166,89 +1005,72 @@ Notice that we may pass in specific values for these parameters during our testi
 
 # main function for the bigrammixture model
 # .015, .0037, 1.0, 0.8
-def bigramBayes(train_set, train_labels, dev_set, unigram_laplace= 0.0003, bigram_laplace= 0.00601, bigram_lambda=.59,pos_prior=0.25, silently=False):
+# bigram_memory: bytes of CountMinSketch for approximate bigram counts (exact if None)
+def bigramBayes(train_set, train_labels, dev_set, unigram_laplace= 0.0003, bigram_laplace= 0.00601, bigram_lambda=.59,pos_prior=0.25, silently=False, engine="loop", workers=1, bigram_memory=None):
     print_paramter_vals_bigram(unigram_laplace,bigram_laplace,bigram_lambda,pos_prior)
+    model = NaiveBayesModel(unigram_laplace, pos_prior, True, bigram_laplace, bigram_lambda, bigram_memory)
+    model.partial_fit(train_set, train_labels, workers)
+    return model.predict(dev_set, engine, silently, workers)
 
-    # UNIGRAM
-    pos_words_freq, neg_words_freq, total_pos_labels, total_neg_labels, total_pos_words, total_neg_words = word_count_dict(train_set, train_labels)
-    unigram_pos = []
-    unigram_neg = []
-    V_pos = len(pos_words_freq)
-    V_neg = len(neg_words_freq)
-    yhats = []
-    for doc in tqdm(dev_set, disable=silently): # for each review
-        pos_prob_post = 0
-        neg_prob_post = 0
-        for word in doc:
-            if word in pos_words_freq:
-                pos_word_log_prob = math.log((pos_words_freq[word] + unigram_laplace) / (total_pos_words + unigram_laplace * (V_pos + 1)))
-            else:
-                pos_word_log_prob = math.log(unigram_laplace / (total_pos_words + unigram_laplace * (V_pos + 1)))  # P(UNK | C)
-            pos_prob_post += pos_word_log_prob
-
-            if word in neg_words_freq:
-                neg_word_log_prob = math.log((neg_words_freq[word] + unigram_laplace) / (total_neg_words + unigram_laplace * (V_neg + 1)))
-            else:
-                neg_word_log_prob = math.log(unigram_laplace / (total_neg_words + unigram_laplace * (V_neg + 1)))
-            neg_prob_post += neg_word_log_prob
-        
-        pos_prob_post += math.log(pos_prior)
-        neg_prob_post += math.log(1 - pos_prior)
-        
-        unigram_pos.append(pos_prob_post)
-        unigram_neg.append(neg_prob_post)
-
-
-    # pos_words_freq, neg_words_freq, total_pos_labels, total_neg_labels, total_pos_words, total_neg_words = word_count_dict(train_set, train_labels)
-    # print("Words: ", total_pos_words, total_neg_words)
-    # # print(len(train_set), train_set[0])
-    pos_pair_freq, neg_pair_freq, pos_total_pairs, neg_total_pairs = pair_count_dict(train_set, train_labels)
-
-    # BIGRAM
-    yhats = []
-    bigram_pos = []
-    bigram_neg = []
-    V_pos = len(pos_pair_freq)
-    V_neg = len(neg_pair_freq)
-    for doc in tqdm(dev_set,disable=silently):
-        pos_prob_post = 0
-        neg_prob_post = 0
-        for i in range(1, len(doc)):
-            word1, word2 = doc[i - 1], doc[i]
-            if (word1, word2) in pos_pair_freq:
-                pos_pair_log_prob = math.log((pos_pair_freq[(word1, word2)] + bigram_laplace) / (pos_total_pairs + bigram_laplace * (V_pos + 1)))
-            else:
-                pos_pair_log_prob = math.log(bigram_laplace / (pos_total_pairs + bigram_laplace * (V_pos + 1)))  # P(UNK | C)
-            pos_prob_post += pos_pair_log_prob
-
-
-            if (word1, word2) in neg_pair_freq:
-                neg_pair_log_prob = math.log((neg_pair_freq[(word1, word2)] + bigram_laplace) / (neg_total_pairs + bigram_laplace * (V_neg + 1)))
-            else:
-                neg_pair_log_prob = math.log(bigram_laplace / (neg_total_pairs + bigram_laplace * (V_neg + 1)))  # P(UNK | C)
-            neg_prob_post += neg_pair_log_prob
-
-        pos_prob_post += math.log(pos_prior)
-        neg_prob_post += math.log(1 - pos_prior)
-
-        bigram_pos.append(pos_prob_post)
-        bigram_neg.append(neg_prob_post)
-
-    for i in range(len(dev_set)):
-        positive_posterior = (1 - bigram_lambda) * unigram_pos[i] +  (bigram_lambda) * bigram_pos[i]
-        negative_posterior = (1 - bigram_lambda) * unigram_neg[i] +  (bigram_lambda) * bigram_neg[i]
-
-        if positive_posterior > negative_posterior:
-            yhats.append(1)
+def fusedScores(unigram_table, bigram_table, dev_set, silently=False):
+    """
+    Unigram and bigram log-likelihoods of every document of dev_set, accumulated together
+    in a single walk over each document's tokens with one joint lookup per word and per
+    pair. Returns four preallocated arrays: unigram positive, unigram negative, bigram
+    positive, bigram negative.
+    """
+    packed = isinstance(dev_set, reader.EncodedCorpus)
+    unigram_pos, unigram_neg = np.empty(len(dev_set)), np.empty(len(dev_set))
+    bigram_pos, bigram_neg = np.empty(len(dev_set)), np.empty(len(dev_set))
+    words, word_unk = unigram_table.joint()
+    pairs, pair_unk = bigram_table.joint()
+    words, pairs = words.get, pairs.get
+    for i, doc in enumerate(reader.progress(dev_set, disable=silently)):
+        uni_pos = uni_neg = bi_pos = bi_neg = 0
+        if len(doc):
+            uni_pos, uni_neg = words(doc[0], word_unk)
+        if packed:
+            for word1, word2 in zip(doc, doc[1:]):
+                pos, neg = words(word2, word_unk)
+                uni_pos += pos
+                uni_neg += neg
+                pos, neg = pairs((word1 << 32) | word2, pair_unk)
+                bi_pos += pos
+                bi_neg += neg
         else:
-            yhats.append(0)
-
-    return yhats
-
-
+            for pair in zip(doc, doc[1:]):
+                pos, neg = words(pair[1], word_unk)
+                uni_pos += pos
+                uni_neg += neg
+                pos, neg = pairs(pair, pair_unk)
+                bi_pos += pos
+                bi_neg += neg
+        unigram_pos[i], unigram_neg[i] = uni_pos, uni_neg
+        bigram_pos[i], bigram_neg[i] = bi_pos, bi_neg
+    return unigram_pos, unigram_neg, bigram_pos, bigram_neg
 
+def bigramBayesMargins(train_set, train_labels, dev_set, unigram_laplace=0.0003, bigram_laplace=0.00601, bigram_lambda=.59, pos_prior=0.25, silently=False):
+    """
+    Binary log-odds version of bigramBayes: returns the positive minus negative mixed
+    posterior of each document of dev_set, so margin > 0 gives the bigramBayes prediction
+    """
+    model = NaiveBayesModel(unigram_laplace, pos_prior, True, bigram_laplace, bigram_lambda).partial_fit(train_set, train_labels)
+    return model.margins(dev_set, silently)
 
 def pair_count_dict(train_set, train_labels):
+    """
+    Bigram counts for each class. The keys are (word1, word2) tuples, except for an
+    EncodedCorpus, whose pairs are packed into one int key (word1 << 32) | word2 and
+    counted by sorting with NumPy (see pairFeatures for the matching dev-side keys)
+    """
+    if isinstance(train_set, reader.EncodedCorpus):
+        keys, indptr = packedPairs(train_set)
+        is_pos = np.repeat(np.asarray(train_labels) == 1, np.diff(indptr))
+        pos_keys, pos_counts = np.unique(keys[is_pos], return_counts=True)
+        neg_keys, neg_counts = np.unique(keys[~is_pos], return_counts=True)
+        pos_pair_freq = dict(zip(pos_keys.tolist(), pos_counts.tolist()))
+        neg_pair_freq = dict(zip(neg_keys.tolist(), neg_counts.tolist()))
+        return pos_pair_freq, neg_pair_freq, int(is_pos.sum()), int(len(keys) - is_pos.sum())
     pos_pair_freq, neg_pair_freq = {}, {}
     pos_total_pairs, neg_total_pairs = 0, 0
     total_words = 0
@@ -278,4 +1100,415 @@ def pair_count_dict(train_set, train_labels):
     # print("Total words: ", total_words)
     # print("Total pairs: ", pos_total_pairs, neg_total_pairs, pos_num_labels, neg_num_labels, pos_total_pairs + pos_num_labels, neg_total_pairs + neg_num_labels)
     # print(pos_pair_freq, neg_pair_freq)
-    return pos_pair_freq, neg_pair_freq, pos_total_pairs, neg_total_pairs
\ No newline at end of file
+    return pos_pair_freq, neg_pair_freq, pos_total_pairs, neg_total_pairs
+
+def print_paramter_vals_ngram(laplaces,lambdas,pos_prior):
+    for k, (laplace, weight) in enumerate(zip(laplaces, lambdas), 1):
+        print(f"{k}-gram Laplace {laplace} Lambda {weight}")
+    print(f"Positive prior {pos_prior}")
+
+# main function for the n-gram mixture model: laplaces and lambdas give the Laplace
+# constant and mixture weight of the 1-grams, 2-grams, ... (up to 4-grams)
+def ngramBayes(train_set, train_labels, dev_set, laplaces=(0.0003, 0.00601), lambdas=(0.41, 0.59), pos_prior=0.25, silently=False):
+    print_paramter_vals_ngram(laplaces,lambdas,pos_prior)
+    model = NgramModel(laplaces, lambdas, pos_prior, getattr(train_set, 'vocab', None))
+    return model.partial_fit(train_set, train_labels).predict(dev_set)
+
+UNKNOWN_TOKEN = 0xFFFFFFFF  # token id of the words an NgramModel never saw
+
+class NgramModel:
+    """
+    Naive Bayes over the 1- to n-grams of the documents, n = len(laplaces) <= 4. Order k
+    has its own Laplace constant laplaces[k - 1] and mixture weight lambdas[k - 1], and
+    the posterior of class C is sum_k lambdas[k - 1] * (log P(k-grams | C) + log P(C)),
+    so bigramBayes is the n = 2 model with lambdas (1 - bigram_lambda, bigram_lambda).
+
+    The n-grams are a trie of token ids: a k-gram's key packs the node id of its (k-1)-gram
+    prefix with its last token, (prefix id << 32) | token, so keys of every order fit in
+    an int64. Each order is a sorted int64 key array, the node id of each key and the
+    class counts by node id, all NumPy arrays. Training and scoring make one vectorized
+    pass over the flat token array per order, each order's node ids found from the
+    previous order's.
+    Documents are lists of words, mapped to ids through the model's Vocabulary, or an
+    EncodedCorpus whose Vocabulary is given as vocab.
+    """
+    def __init__(self, laplaces=(0.0003, 0.00601), lambdas=(0.41, 0.59), pos_prior=0.25, vocab=None):
+        if not 1 <= len(laplaces) <= 4 or len(lambdas) != len(laplaces):
+            raise ValueError(f"need 1 to 4 orders with one lambda each, got {len(laplaces)} laplaces "
+                             f"and {len(lambdas)} lambdas")
+        self.laplaces, self.lambdas = tuple(laplaces), tuple(lambdas)
+        self.pos_prior = pos_prior
+        self.vocab = reader.Vocabulary() if vocab is None else vocab
+        n = len(laplaces)
+        self.keys = [np.empty(0, dtype=np.int64) for _ in range(n)]
+        self.ids = [np.empty(0, dtype=np.int64) for _ in range(n)]
+        self.pos_counts = [np.empty(0, dtype=np.int64) for _ in range(n)]
+        self.neg_counts = [np.empty(0, dtype=np.int64) for _ in range(n)]
+        self.pos_totals, self.neg_totals = [0] * n, [0] * n
+        self.total_pos_labels, self.total_neg_labels = 0, 0
+        self._tables = None
+
+    def tokenArrays(self, docs, grow=False):
+        """
+        int64 token ids and document offsets of docs. With grow, the new words of
+        lists-of-words documents join the vocabulary; otherwise they are UNKNOWN_TOKEN
+        """
+        if isinstance(docs, reader.EncodedCorpus):
+            return (np.frombuffer(docs.tokens, dtype=np.uint32).astype(np.int64),
+                    np.frombuffer(docs.offsets, dtype=np.uint32).astype(np.int64))
+        ids = self.vocab.ids
+        lookup = self.vocab.add if grow else lambda word: ids.get(word, UNKNOWN_TOKEN)
+        tokens, offsets = [], [0]
+        for doc in docs:
+            tokens.extend(map(lookup, doc))
+            offsets.append(len(tokens))
+        return np.array(tokens, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+    def walk(self, tokens, offsets, grow=False):
+        """
+        Yields (order, nodes, valid) for orders 0 (unigrams) to n - 1: the node id of the
+        (order + 1)-gram ending at each token, and where there is one (not too close to
+        the start of its document). With grow the n-grams are added to the trie; without,
+        unseen ones get node -1.
+        """
+        lengths = np.diff(offsets)
+        positions = np.arange(len(tokens)) - np.repeat(offsets[:-1], lengths)
+        nodes = None
+        for order in range(len(self.laplaces)):
+            if order == 0:
+                keys = tokens
+            else:
+                prefix = np.full(len(tokens), -1, dtype=np.int64)
+                prefix[1:] = nodes[:-1]
+                keys = (prefix << 32) | tokens
+            valid = positions >= order
+            nodes = np.full(len(tokens), -1, dtype=np.int64)
+            nodes[valid] = self.insert(order, keys[valid]) if grow else self.lookup(order, keys[valid])
+            yield order, nodes, valid
+
+    def lookup(self, order, keys):
+        # Node id of each key of the order, -1 for unseen keys
+        return np.append(self.ids[order], -1)[searchKeys(self.keys[order], keys)]
+
+    def insert(self, order, keys):
+        # Node id of each key of the order, giving new keys the next free ids
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sorted_keys, ids = self.keys[order], self.ids[order]
+        found = np.searchsorted(sorted_keys, unique)
+        known = found < len(sorted_keys)
+        known[known] = sorted_keys[found[known]] == unique[known]
+        nodes = np.empty(len(unique), dtype=np.int64)
+        nodes[known] = ids[found[known]]
+        new = ~known
+        nodes[new] = np.arange(len(ids), len(ids) + new.sum())
+        merged = np.concatenate((sorted_keys, unique[new]))
+        by_key = np.argsort(merged, kind='stable')
+        self.keys[order] = merged[by_key]
+        self.ids[order] = np.concatenate((ids, nodes[new]))[by_key]
+        return nodes[inverse]
+
+    def partial_fit(self, docs, labels):
+        # Adds the counts of more labeled documents; returns the model
+        tokens, offsets = self.tokenArrays(docs, grow=True)
+        labels = np.asarray(labels) == 1
+        self.total_pos_labels += int(labels.sum())
+        self.total_neg_labels += int(len(labels) - labels.sum())
+        is_pos = np.repeat(labels, np.diff(offsets))
+        for order, nodes, valid in self.walk(tokens, offsets, grow=True):
+            size = len(self.ids[order])
+            for counts, in_class, totals in ((self.pos_counts, valid & is_pos, self.pos_totals),
+                                             (self.neg_counts, valid & ~is_pos, self.neg_totals)):
+                added = np.bincount(nodes[in_class], minlength=size)
+                added[:len(counts[order])] += counts[order]
+                counts[order] = added
+                totals[order] += int(in_class.sum())
+        self._tables = None
+        return self
+
+    def tables(self):
+        """
+        Positive and negative log P(k-gram | C) of every order, indexed by node id, with
+        log P(UNK | C) as the last entry (so node -1 looks up UNK). Smoothed like
+        LogProbTable: (count + L) / (total + L * (distinct k-grams of C + 1)).
+        """
+        if self._tables is None:
+            self._tables = []
+            for order, laplace in enumerate(self.laplaces):
+                table = []
+                for counts, total in ((self.pos_counts[order], self.pos_totals[order]),
+                                      (self.neg_counts[order], self.neg_totals[order])):
+                    denom = total + laplace * (np.count_nonzero(counts) + 1)
+                    table.append(np.log(np.append(counts, 0) + laplace) - math.log(denom))
+                self._tables.append(table)
+        return self._tables
+
+    def scores(self, docs):
+        """
+        Positive and negative mixed posterior arrays of docs, each order scored in one
+        vectorized pass over the documents' tokens
+        """
+        tokens, offsets = self.tokenArrays(docs)
+        doc_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        tables = self.tables()
+        pos_log_prior, neg_log_prior = math.log(self.pos_prior), math.log(1 - self.pos_prior)
+        positive_posterior, negative_posterior = 0, 0
+        for order, nodes, valid in self.walk(tokens, offsets):
+            pos_probs, neg_probs = tables[order]
+            # per-document sums, added in token order like LogProbTable.score
+            pos = np.bincount(doc_index[valid], pos_probs[nodes[valid]], minlength=len(offsets) - 1)
+            neg = np.bincount(doc_index[valid], neg_probs[nodes[valid]], minlength=len(offsets) - 1)
+            weight = self.lambdas[order]
+            positive_posterior = positive_posterior + weight * (pos + pos_log_prior)
+            negative_posterior = negative_posterior + weight * (neg + neg_log_prior)
+        return positive_posterior, negative_posterior
+
+    def predict(self, docs):
+        # Returns the 1 (positive) / 0 (negative) label of each document
+        positive_posterior, negative_posterior = self.scores(docs)
+        return (positive_posterior > negative_posterior).astype(int).tolist()
+
+class SweepStatistics:
+    """
+    Everything a hyperparameter sweep needs, counted once from a trained NaiveBayesModel:
+    for each dev document, how many times it uses each distinct dev feature (a sparse
+    document-feature matrix), the training counts of those features in both classes,
+    and the class totals and vocabulary sizes. Since
+        sum log((c + L) / (N + L * (V + 1))) = sum log(c + L) - len(doc) * log(N + L * (V + 1))
+    every smoothing constant is then one matrix product, with no re-tokenizing or re-counting.
+    """
+    def __init__(self, model, dev_set):
+        if model.pos_pair_sketch is not None:
+            raise ValueError("SweepStatistics needs exact bigram counts, not a bigram_memory sketch")
+        self.bigram = model.bigram
+        self.unigram = self._features(dev_set, model.pos_words_freq, model.neg_words_freq, False)
+        self.unigram_totals = (model.total_pos_words, len(model.pos_words_freq),
+                               model.total_neg_words, len(model.neg_words_freq))
+        if self.bigram:
+            self.pairs = self._features(dev_set, model.pos_pair_freq, model.neg_pair_freq, True)
+            self.pair_totals = (model.pos_total_pairs, len(model.pos_pair_freq),
+                                model.neg_total_pairs, len(model.neg_pair_freq))
+
+    def _features(self, dev_set, pos_freq, neg_freq, bigram):
+        # (document-feature count matrix, document lengths, pos counts, neg counts)
+        import scipy.sparse
+        packed = isinstance(dev_set, reader.EncodedCorpus)
+        index = {}
+        cols, indptr = [], [0]
+        for doc in dev_set:
+            features = pairFeatures(doc, packed) if bigram else doc
+            cols.extend([index.setdefault(f, len(index)) for f in features])
+            indptr.append(len(cols))
+        X = scipy.sparse.csr_matrix((np.ones(len(cols)), cols, indptr), shape=(len(indptr) - 1, len(index)))
+        pos_counts = np.array([pos_freq.get(f, 0) for f in index], dtype=float)
+        neg_counts = np.array([neg_freq.get(f, 0) for f in index], dtype=float)
+        return X, np.diff(indptr), pos_counts, neg_counts
+
+    def loglikelihoods(self, laplaces, bigram=False):
+        # Positive and negative log-likelihoods of every dev document, (docs x len(laplaces))
+        X, lengths, pos_counts, neg_counts = self.pairs if bigram else self.unigram
+        total_pos, V_pos, total_neg, V_neg = self.pair_totals if bigram else self.unigram_totals
+        laplaces = np.asarray(laplaces, dtype=float)
+        pos = X @ np.log(pos_counts[:, None] + laplaces) - np.outer(lengths, np.log(total_pos + laplaces * (V_pos + 1)))
+        neg = X @ np.log(neg_counts[:, None] + laplaces) - np.outer(lengths, np.log(total_neg + laplaces * (V_neg + 1)))
+        return pos, neg
+
+    def evaluate(self, dev_labels, laplaces, pos_priors, bigram_laplaces=(0.00601,), bigram_lambdas=(0.0,)):
+        """
+        Accuracy and confusion numbers for every point of the grid. Returns a list of
+        (laplace, bigram_laplace, bigram_lambda, pos_prior, accuracy, fp, fn, tp, tn)
+        tuples, the same numbers mp1.compute_accuracies reports. Without bigram counts
+        only the unigram grid is used.
+        """
+        gold = np.asarray(dev_labels) == 1
+        if not self.bigram:
+            bigram_laplaces, bigram_lambdas = (None,), (0.0,)
+        priors = np.asarray(pos_priors, dtype=float)
+        lambdas = np.asarray(bigram_lambdas, dtype=float)[:, None, None]
+        pos_log_prior, neg_log_prior = np.log(priors)[:, None], np.log(1 - priors)[:, None]
+        unigram_pos, unigram_neg = self.loglikelihoods(laplaces)
+        if self.bigram:
+            bigram_pos, bigram_neg = self.loglikelihoods(bigram_laplaces, bigram=True)
+        results = []
+        for i, laplace in enumerate(laplaces):
+            for j, bigram_laplace in enumerate(bigram_laplaces):
+                # (lambdas x priors x docs) posteriors
+                positive_posterior = unigram_pos[:, i] + pos_log_prior
+                negative_posterior = unigram_neg[:, i] + neg_log_prior
+                if self.bigram:
+                    positive_posterior = (1 - lambdas) * positive_posterior + lambdas * (bigram_pos[:, j] + pos_log_prior)
+                    negative_posterior = (1 - lambdas) * negative_posterior + lambdas * (bigram_neg[:, j] + neg_log_prior)
+                else:
+                    positive_posterior, negative_posterior = positive_posterior[None], negative_posterior[None]
+                yhats = positive_posterior > negative_posterior
+                tp = (yhats & gold).sum(axis=-1)
+                tn = (~yhats & ~gold).sum(axis=-1)
+                fp = (yhats & ~gold).sum(axis=-1)
+                fn = (~yhats & gold).sum(axis=-1)
+                for k, bigram_lambda in enumerate(bigram_lambdas):
+                    for m, pos_prior in enumerate(pos_priors):
+                        accuracy = float(tp[k, m] + tn[k, m]) / len(gold)
+                        results.append((laplace, bigram_laplace, bigram_lambda, pos_prior, accuracy,
+                                        int(fp[k, m]), int(fn[k, m]), int(tp[k, m]), int(tn[k, m])))
+        return results
+
+
+def countShard(docs, labels, bigram, bigram_memory=None):
+    # Map task: the counts of one shard of documents
+    return NaiveBayesModel(bigram=bigram, bigram_memory=bigram_memory).partial_fit(docs, labels)
+
+def countFiles(name, files, label, stemming, lower_case, bigram, token_filter=None):
+    # Map task: reads, tokenizes and counts one shard of files of a folder with one label
+    docs, stems = reader.loadFiles(name, files, stemming, lower_case, token_filter)
+    return packModel(countShard(docs, [label] * len(docs), bigram))
+
+def packModel(model):
+    # A partial model as pickled bytes: the parent only passes these on to merge tasks,
+    # so the pickling and unpickling is done by the workers, in parallel
+    return pickle.dumps(model, pickle.HIGHEST_PROTOCOL)
+
+def mergePacked(packed, other):
+    # Reduce task: merges two pickled partial models into one
+    return packModel(pickle.loads(packed).merge(pickle.loads(other)))
+
+def treeReduce(pool, futures):
+    # Merges the pickled models of futures pairwise, level by level, each merge a pool
+    # task, so a level's merges run in parallel and there are log2(shards) rounds. The
+    # last two models are merged here rather than pickled once more for a worker
+    while len(futures) > 2:
+        merged = [pool.submit(mergePacked, futures[i].result(), futures[i + 1].result())
+                  for i in range(0, len(futures) - 1, 2)]
+        if len(futures) % 2:
+            merged.append(futures[-1])
+        futures = merged
+    model = pickle.loads(futures[0].result())
+    for future in futures[1:]:
+        model.merge(pickle.loads(future.result()))
+    return model
+
+MIN_SHARD_DOCS = 100  # mapReduceCounts counts in-process rather than give a worker fewer
+
+def countingShards(n, workers):
+    # Ranges splitting n items into one contiguous shard per worker: unlike scoring, every
+    # extra shard is one more partial model to send back and merge
+    size = -(-n // workers) or 1
+    return [range(i, min(i + size, n)) for i in range(0, n, size)]
+
+worker_state = None  # the state of the current sharedPool, as its workers see it
+
+def initSharedWorker(state):
+    # Pool initializer; with fork the state is inherited, not pickled per task
+    global worker_state
+    worker_state = state
+
+@contextmanager
+def sharedPool(workers, state):
+    """
+    A pool of worker processes that all see state (documents, a model, ...) as
+    worker_state, so tasks only need to carry index ranges. With fork the state is
+    shared copy-on-write; gc.freeze keeps the collector from touching, and so copying,
+    the shared pages.
+    """
+    gc.freeze()
+    try:
+        with ProcessPoolExecutor(workers, initializer=initSharedWorker, initargs=(state,)) as pool:
+            yield pool
+    finally:
+        gc.unfreeze()
+
+def countSlice(bounds):
+    # Map task: the counts of one range of the shared documents
+    docs, labels, bigram, bigram_memory = worker_state
+    return packModel(countShard(docs[bounds.start:bounds.stop], labels[bounds.start:bounds.stop],
+                                bigram, bigram_memory))
+
+def mapReduceCounts(docs, labels, workers=2, bigram=False, bigram_memory=None):
+    """
+    Counts docs on a sharedPool of worker processes: each worker counts one contiguous
+    range of the documents and the partial models are merged in a tree reduction. Too
+    few documents for two shards of MIN_SHARD_DOCS are counted in this process. The
+    result has exactly the counts of NaiveBayesModel(bigram=bigram,
+    bigram_memory=bigram_memory).partial_fit(docs, labels).
+    """
+    workers = min(workers, len(labels) // MIN_SHARD_DOCS)
+    if workers < 2:
+        return countShard(docs, labels, bigram, bigram_memory)
+    with sharedPool(workers, (docs, labels, bigram, bigram_memory)) as pool:
+        return treeReduce(pool, [pool.submit(countSlice, shard) for shard in countingShards(len(labels), workers)])
+
+def mapReduceDirs(train_dir, workers=2, stemming=False, lower_case=True, bigram=False, token_filter=None):
+    """
+    Like mapReduceCounts, but the workers read and tokenize their shards of files
+    straight from train_dir/pos and train_dir/neg, so only counts ever reach the parent
+    """
+    with reader.makePool(workers) as pool:
+        futures = []
+        for label, folder in ((1, '/pos/'), (0, '/neg/')):
+            name = train_dir + folder
+            files = os.listdir(name)
+            futures += [pool.submit(countFiles, name, files[shard.start:shard.stop], label, stemming, lower_case,
+                                    bigram, token_filter)
+                        for shard in countingShards(len(files), workers)]
+        if not futures:
+            return NaiveBayesModel(bigram=bigram)
+        return treeReduce(pool, futures)
+
+def predictSlice(bounds):
+    # Scoring task: the predictions of one range of the shared documents
+    model, docs, engine = worker_state
+    return model.predict(docs[bounds.start:bounds.stop], engine, silently=True)
+
+def parallelPredict(model, docs, engine="loop", workers=2):
+    """
+    Scores docs on a sharedPool of worker processes, each task one contiguous slice, and
+    returns the predictions in input order. The model's tables are built once in this
+    process and shared with the workers (fork copy-on-write, or the mapped file of a
+    MappedModel); tasks never carry the model.
+    """
+    if not len(docs):
+        return []
+    model.prepare(engine, isinstance(docs, reader.EncodedCorpus))
+    with sharedPool(workers, (model, docs, engine)) as pool:
+        slices = pool.map(predictSlice, reader.splitFiles(range(len(docs)), workers))
+        return [yhat for predictions in slices for yhat in predictions]
+
+def foldResults(fold):
+    # Sweep results of one fold: the corpus-wide counts minus the held-out fold's
+    # counts, evaluated on the held-out documents
+    model, docs, labels, folds, grid = worker_state
+    held_out = folds[fold]
+    if isinstance(docs, reader.EncodedCorpus):
+        fold_docs = docs.take(held_out)
+    else:
+        fold_docs = [docs[i] for i in held_out]
+    fold_labels = [labels[i] for i in held_out]
+    fold_model = NaiveBayesModel(bigram=model.bigram).partial_fit(fold_docs, fold_labels)
+    trained = model.copy().subtract(fold_model)
+    return SweepStatistics(trained, fold_docs).evaluate(fold_labels, *grid)
+
+def crossValidate(train_set, train_labels, k=5, workers=1, laplaces=(0.001,), pos_priors=(0.8,),
+                  bigram=False, bigram_laplaces=(0.00601,), bigram_lambdas=(0.0,)):
+    """
+    k-fold cross-validation of every point of a parameter grid. The counts of the whole
+    train_set are computed once; each fold's model is those counts minus the held-out
+    fold's own counts, and the folds run in parallel worker processes. Document i goes to
+    fold i % k. Returns the SweepStatistics.evaluate tuples with the confusion numbers
+    summed over the folds (so accuracy is over all of train_set).
+    """
+    if not 2 <= k <= len(train_labels):
+        raise ValueError(f"need 2 to {len(train_labels)} folds, got {k}")
+    model = NaiveBayesModel(bigram=bigram).partial_fit(train_set, train_labels)
+    folds = [list(range(fold, len(train_labels), k)) for fold in range(k)]
+    grid = (laplaces, pos_priors, bigram_laplaces, bigram_lambdas)
+    state = (model, train_set, train_labels, folds, grid)
+    if workers > 1:
+        with sharedPool(workers, state) as pool:
+            fold_results = list(pool.map(foldResults, range(k)))
+    else:
+        initSharedWorker(state)
+        fold_results = [foldResults(fold) for fold in range(k)]
+
+    results = []
+    for points in zip(*fold_results):
+        fp, fn, tp, tn = [sum(point[i] for point in points) for i in range(5, 9)]
+        results.append(points[0][:4] + ((tp + tn) / len(train_labels), fp, fn, tp, tn))
+    return results
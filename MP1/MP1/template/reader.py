@@ -9,49 +9,708 @@
 """
 This file is responsible for providing functions for reading the files
 """
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+from array import array
+from itertools import islice
 from os import listdir
-from nltk.stem.porter import PorterStemmer
-from nltk.tokenize import RegexpTokenizer
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
-porter_stemmer = PorterStemmer()
-tokenizer = RegexpTokenizer(r'\w+')
+# nltk takes about a second to import and tqdm is only needed for visible progress
+# bars, so both are imported on first use: porter_stemmer and tokenizer are created
+# by stemmer() and wordTokenizer() (reader.porter_stemmer / reader.tokenizer work too)
+word_pattern = re.compile(r'\w+')
+agreeing_chars = {}  # non-ASCII character -> whether word_pattern and tokenizer both see it as \w or both don't
 bad_words = {'aed','oed','eed'} # these words fail in nltk stemmer algorithm
-def loadDir(name,stemming,lower_case,silently=False):
-    # Loads the files in the folder and returns a list of lists of words from
-    # the text in each file
-    X0 = []
-    count = 0
-    for f in tqdm(listdir(name),disable=silently):
-        fullname = name+f
-        text = []
-        with open(fullname, 'rb') as f:
+stem_table = {}  # surface form -> stem, shared by every loadDir call in this process
+intern_table = {}  # word -> the one str object every interned document uses for it
+STOP_WORDS = frozenset(["i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your", "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "her", "hers", "herself", "it", "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who", "whom", "this", "that", "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an", "the", "and", "but", "if", "or", "because", "as", "until", "while", "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during", "before", "after", "above", "below", "to", "from", "up", "down", "in", "out", "on", "off", "over", "under", "again", "further", "then", "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few", "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s", "t", "can", "will", "just", "don", "should", "now"])
+
+class TokenFilter:
+    """
+    Drops tokens while a file is tokenized, before stemming: the stop words (a set, so
+    one hash lookup per token), tokens shorter than min_length characters and, with
+    drop_numeric=True, tokens made only of digits. Pass one as token_filter to loadDir,
+    load_dataset, ...; it is applied to each file's words in one pass.
+    """
+    def __init__(self, stop_words=STOP_WORDS, min_length=1, drop_numeric=False):
+        self.stop_words = frozenset(stop_words)
+        self.min_length = min_length
+        self.drop_numeric = drop_numeric
+
+    def __call__(self, words):
+        stop_words, min_length = self.stop_words, self.min_length
+        if self.drop_numeric:
+            return [w for w in words if w not in stop_words and len(w) >= min_length and not w.isdigit()]
+        return [w for w in words if w not in stop_words and len(w) >= min_length]
+
+    def key(self):
+        # The settings as a string, for cacheKey and folderKey
+        return f"{sorted(self.stop_words)} {self.min_length} {self.drop_numeric}"
+
+def stemmer():
+    # nltk's PorterStemmer, created on first use
+    global porter_stemmer
+    if 'porter_stemmer' not in globals():
+        from nltk.stem.porter import PorterStemmer
+        porter_stemmer = PorterStemmer()
+    return porter_stemmer
+
+def wordTokenizer():
+    # nltk's RegexpTokenizer(r'\w+'), created on first use
+    global tokenizer
+    if 'tokenizer' not in globals():
+        from nltk.tokenize import RegexpTokenizer
+        tokenizer = RegexpTokenizer(r'\w+')
+    return tokenizer
+
+def __getattr__(name):
+    # Module attributes that are created on first use
+    if name == 'porter_stemmer':
+        return stemmer()
+    if name == 'tokenizer':
+        return wordTokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class NoProgress:
+    # What progress returns for a hidden bar: iterates like the iterable, ignores updates
+    def __init__(self, iterable=None):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n=1):
+        pass
+
+def progress(iterable=None, disable=False, **kwargs):
+    # tqdm(iterable, disable=disable, **kwargs), importing tqdm only to show a bar
+    if disable:
+        return NoProgress(iterable)
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
+
+def stemWords(text):
+    # Stems the words in place, running the Porter stemmer once per distinct word
+    for i in range(len(text)):
+        stem = stem_table.get(text[i])
+        if stem is None:
+            word = text[i]
+            stem = word if word in bad_words else stemmer().stem(word)
+            stem_table[word] = stem
+        text[i] = stem
+
+def internWords(text):
+    # Replaces the words in place by their shared copies in intern_table, so a word
+    # repeated across documents is one object instead of one per occurrence
+    text[:] = map(intern_table.setdefault, text, text)
+    return text
+
+def loadStemTable(path):
+    # Adds the stems saved by saveStemTable to the in-memory table
+    try:
+        with open(path, encoding='utf-8') as f:
             for line in f:
-                if lower_case:
-                    line = line.decode(errors='ignore').lower()
-                    text += tokenizer.tokenize(line)
-                    
-                else:
-                    text += tokenizer.tokenize(line.decode(errors='ignore'))
-        if stemming:
-            for i in range(len(text)):
-                if text[i] in bad_words:
-                    continue
-                text[i] = porter_stemmer.stem(text[i])
-        X0.append(text)
-        count = count + 1
+                word, stem = line.rstrip('\n').split('\t')
+                stem_table[word] = stem
+    except (OSError, ValueError):
+        pass
+
+def saveStemTable(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.writelines(f"{word}\t{stem}\n" for word, stem in stem_table.items())
+    os.replace(tmp, path)
+
+def initWorker(stems):
+    # Pool initializer: start every worker with the stems known to the parent
+    stem_table.update(stems)
+
+def makePool(workers):
+    return ProcessPoolExecutor(workers, initializer=initWorker, initargs=(stem_table,))
+
+def tokenizeBytes(data,lower_case):
+    # The \w+ words of a whole file's bytes (or any bytes-like object, e.g. a slice of a
+    # mapped PackedDir), the same words tokenizer.tokenize finds line by line: the file
+    # is decoded and lowercased once and matched with one findall of the precompiled
+    # word_pattern. Which non-ASCII characters \w matches depends on the regex engine
+    # (nltk's may not be re), so a file with a character the two disagree on goes
+    # through tokenizer itself
+    text = str(data, 'utf-8', 'ignore')
+    if lower_case:
+        text = text.lower()
+    if not text.isascii():
+        for c in set(text):
+            if c > '\x7f':
+                agrees = agreeing_chars.get(c)
+                if agrees is None:
+                    agrees = agreeing_chars[c] = bool(word_pattern.fullmatch(c)) == (wordTokenizer().tokenize(c) == [c])
+                if not agrees:
+                    return wordTokenizer().tokenize(text)
+    return word_pattern.findall(text)
+
+def loadFile(fullname,stemming,lower_case,token_filter=None,interned=False):
+    # Returns the list of words from the text in one file
+    with open(fullname, 'rb') as f:
+        return loadText(f.read(),stemming,lower_case,token_filter,interned)
+
+def loadText(data,stemming,lower_case,token_filter=None,interned=False):
+    # Returns the list of words from the bytes of one file (interned: see internWords)
+    text = tokenizeBytes(data,lower_case)
+    if token_filter is not None:
+        text = token_filter(text)
+    if stemming:
+        stemWords(text)
+    if interned:
+        internWords(text)
+    return text
+
+def loadFiles(name,files,stemming,lower_case,token_filter=None):
+    # Worker task: loads one chunk of the files in a folder. Also returns the
+    # stems this task added so the parent can merge them into its own table
+    known = len(stem_table)
+    docs = [loadFile(name+f,stemming,lower_case,token_filter) for f in files]
+    return docs, dict(islice(stem_table.items(), known, None))
+
+def loadPacked(path,indices,stemming,lower_case,token_filter=None):
+    # Worker task: loadFiles for a range of the files of a PackedDir
+    known = len(stem_table)
+    with PackedDir(path) as pack:
+        docs = [loadText(pack[i],stemming,lower_case,token_filter) for i in indices]
+    return docs, dict(islice(stem_table.items(), known, None))
+
+PACK_MAGIC = b'MP1PACK2'
+PACK_HEADER = struct.Struct('<8sQQ')   # magic, number of files, bytes of file names
+PACK_DIR = os.path.join(tempfile.gettempdir(), 'mp1_packs')  # where packs go without a pack_dir
+
+def packPath(name,pack_dir=None):
+    # Where the PackedDir of a folder goes: in pack_dir (PACK_DIR by default), never in
+    # the data tree, named after the folder and a digest of its absolute path, e.g.
+    # data/train/pos/ -> <pack_dir>/pos-<digest>.pack
+    path = os.path.abspath(name)
+    digest = hashlib.sha1(path.encode()).hexdigest()[:12]
+    return os.path.join(pack_dir or PACK_DIR, f"{os.path.basename(path)}-{digest}.pack")
+
+def packDir(name,path=None):
+    """
+    Concatenates the files of a folder into one file for PackedDir: the header, the
+    '\n'-joined file names (in listdir order), the int64 mtime (ns) index of the files,
+    the uint64 offset index of each file's bytes (one more entry for the end, so the
+    sizes are the differences) and then the bytes of every file. Returns the path.
+    """
+    path = path or packPath(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    files = listdir(name)
+    names = '\n'.join(files).encode()
+    mtimes = array('q')
+    offsets = array('Q', [0])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as out:
+        out.write(PACK_HEADER.pack(PACK_MAGIC, len(files), len(names)))
+        out.write(names)
+        index_start = out.tell()
+        out.write(bytes(8 * (2 * len(files) + 1)))
+        for f in files:
+            # stat before reading, so a file changed in between looks stale next time
+            mtimes.append(os.stat(name + f).st_mtime_ns)
+            with open(name + f, 'rb') as review:
+                offsets.append(offsets[-1] + out.write(review.read()))
+        out.seek(index_start)
+        mtimes.tofile(out)
+        offsets.tofile(out)
+    os.replace(tmp, path)
+    return path
+
+def packCurrent(name,path):
+    # Whether the pack at path holds exactly the files of the folder now: the same
+    # names in the same order, each with the size and mtime it was packed with
+    try:
+        pack = PackedDir(path)
+    except (OSError, ValueError):
+        return False
+    with pack:
+        if pack.names != listdir(name):
+            return False
+        for i, f in enumerate(pack.names):
+            st = os.stat(name + f)
+            if st.st_size != pack.offsets[i + 1] - pack.offsets[i] or st.st_mtime_ns != pack.mtimes[i]:
+                return False
+    return True
+
+def ensurePacked(name,pack_dir=None):
+    # The PackedDir path of a folder, packing it first if it hasn't been or if the
+    # folder changed since (a file added, removed, resized or touched)
+    path = packPath(name,pack_dir)
+    if not packCurrent(name, path):
+        packDir(name, path)
+    return path
+
+class PackedDir:
+    """
+    A folder packed by packDir, read through one mmap of the pack: names holds the file
+    names, mtimes their packed mtimes and pack[i] is a memoryview of the bytes of file i,
+    sliced straight out of the mapping with the offset index (no open/read per file, no
+    copy). Close it, or use it in a with block, when the views are no longer needed.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < PACK_HEADER.size or PACK_HEADER.unpack_from(self.map)[0] != PACK_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a packed folder")
+        magic, num_files, num_bytes = PACK_HEADER.unpack_from(self.map)
+        start = PACK_HEADER.size
+        self.names = self.map[start:start + num_bytes].decode().split('\n') if num_files else []
+        start += num_bytes
+        self.mtimes = array('q')
+        self.mtimes.frombytes(self.map[start:start + 8 * num_files])
+        start += 8 * num_files
+        self.offsets = array('Q')
+        self.offsets.frombytes(self.map[start:start + 8 * (num_files + 1)])
+        self.data = memoryview(self.map)[start + 8 * (num_files + 1):]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def close(self):
+        self.data.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def splitFiles(files,workers):
+    # Splits the file list into contiguous chunks, a few per worker so that
+    # slow chunks don't leave the other processes idle
+    if not len(files):
+        return []
+    num_chunks = min(len(files), workers * 4)
+    size = -(-len(files) // num_chunks)
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+def submitDir(pool,name,stemming,lower_case,workers,token_filter=None,packed=False,pack_dir=None):
+    if packed:
+        path = ensurePacked(name,pack_dir)
+        with PackedDir(path) as pack:
+            num_files = len(pack)
+        return [pool.submit(loadPacked,path,chunk,stemming,lower_case,token_filter)
+                for chunk in splitFiles(range(num_files),workers)]
+    return [pool.submit(loadFiles,name,chunk,stemming,lower_case,token_filter)
+            for chunk in splitFiles(listdir(name),workers)]
+
+def collectDirs(jobs,silently=False,outs=None,interned=False):
+    # Waits for the chunks of each folder in submission order, so the documents
+    # come back in the same order as the sequential loadDir. Interning is done
+    # here: words shared inside a worker's chunk are not shared across chunks
+    outs = outs or [[] for futures in jobs]
+    with progress(total=sum(len(futures) for futures in jobs),disable=silently) as bar:
+        for futures, X0 in zip(jobs, outs):
+            for future in futures:
+                docs, stems = future.result()
+                if interned:
+                    for doc in docs:
+                        internWords(doc)
+                X0.extend(docs)
+                stem_table.update(stems)
+                bar.update()
+    return outs
+
+def loadDir(name,stemming,lower_case,silently=False,workers=1,out=None,token_filter=None,packed=False,interned=False,
+            pack_dir=None):
+    # Loads the files in the folder and returns a list of lists of words from
+    # the text in each file. If out is given (e.g. an EncodedCorpus) the
+    # documents are appended to it as they are read and it is returned instead.
+    # token_filter (a TokenFilter) drops words as each file is tokenized. With
+    # packed the files are read from the folder's PackedDir (packed on first use,
+    # into pack_dir). With interned every occurrence of a word is the same str (see internWords)
+    X0 = [] if out is None else out
+    if workers > 1:
+        with makePool(workers) as pool:
+            jobs = [submitDir(pool,name,stemming,lower_case,workers,token_filter,packed,pack_dir)]
+            return collectDirs(jobs,silently,[X0],interned)[0]
+    if packed:
+        with PackedDir(ensurePacked(name,pack_dir)) as pack:
+            for i in progress(range(len(pack)),disable=silently):
+                X0.append(loadText(pack[i],stemming,lower_case,token_filter,interned))
+        return X0
+    for f in progress(listdir(name),disable=silently):
+        X0.append(loadFile(name+f,stemming,lower_case,token_filter,interned))
     return X0
 
-def load_dataset(train_dir, dev_dir, stemming=False, lower_case=False, silently=True):
+def streamDir(name,stemming,lower_case,token_filter=None):
+    # Yields the list of words of each file in the folder, reading one file at a time
+    for f in listdir(name):
+        yield loadFile(name+f,stemming,lower_case,token_filter)
 
-    X0 = loadDir(train_dir + '/pos/',stemming, lower_case, silently)
-    X1 = loadDir(train_dir + '/neg/',stemming, lower_case, silently)
-    X = X0 + X1
-    Y = len(X0) * [1] + len(X1) * [0]
+def streamDataset(data_dir,stemming=False,lower_case=False,token_filter=None):
+    # Yields (words, label) for every review in data_dir/pos (1) and data_dir/neg (0)
+    # without ever holding more than one file's words
+    for doc in streamDir(data_dir + '/pos/',stemming,lower_case,token_filter):
+        yield doc, 1
+    for doc in streamDir(data_dir + '/neg/',stemming,lower_case,token_filter):
+        yield doc, 0
+
+class Vocabulary:
+    """
+    Maps words to dense integer ids, in order of first appearance
+    """
+    def __init__(self, words=()):
+        self.words = list(words)
+        self.ids = {w: i for i, w in enumerate(self.words)}
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, word):
+        # Returns the id of the word, giving it the next free id if it is new
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def get(self, word, default=None):
+        return self.ids.get(word, default)
+
+    def encode(self, doc):
+        add = self.add
+        return [add(w) for w in doc]
+
+    def decode(self, ids):
+        return list(map(self.words.__getitem__, ids))
+
+class EncodedCorpus:
+    """
+    A list of documents stored as one flat array of token ids plus an array of
+    document boundaries: document i is tokens[offsets[i]:offsets[i + 1]].
+    Indexing and iterating give the id arrays of the documents, so the naive
+    Bayes functions can use an EncodedCorpus wherever they take a list of
+    lists of words (all splits scored together must share one Vocabulary).
+    """
+    def __init__(self, vocab=None, tokens=None, offsets=None):
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.tokens = array('I') if tokens is None else tokens
+        self.offsets = array('I', [0]) if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, "EncodedCorpus only supports contiguous slices"
+            stop = max(start, stop)
+            base = self.offsets[start]
+            offsets = array('I', [o - base for o in self.offsets[start:stop + 1]])
+            return EncodedCorpus(self.vocab, self.tokens[base:self.offsets[stop]], offsets)
+        if i < 0:
+            i += len(self)
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        tokens, offsets = self.tokens, self.offsets
+        for i in range(len(offsets) - 1):
+            yield tokens[offsets[i]:offsets[i + 1]]
+
+    def take(self, indices):
+        # Returns a new EncodedCorpus (same Vocabulary) with the documents at indices
+        corpus = EncodedCorpus(self.vocab)
+        for i in indices:
+            corpus.tokens.extend(self[i])
+            corpus.offsets.append(len(corpus.tokens))
+        return corpus
+
+    def append(self, doc):
+        self.tokens.extend(self.vocab.encode(doc))
+        self.offsets.append(len(self.tokens))
+
+    def appendIds(self, ids):
+        # Appends a document already encoded in this corpus's Vocabulary
+        self.tokens.extend(ids)
+        self.offsets.append(len(self.tokens))
+
+    def extend(self, docs):
+        for doc in docs:
+            self.append(doc)
+
+    def decode(self):
+        # Returns the corpus as a list of lists of words
+        return [self.vocab.decode(doc) for doc in self]
+
+CACHE_MAGIC = b'MP1TOK03'
+CACHE_HEADER = struct.Struct('<8s20s4III')   # magic, fingerprint, docs per folder, vocab bytes, tokens
+
+def folderKey(kind,dirs,stemming,lower_case,token_filter=None):
+    # Names a cache file (kind: 'tokens', 'manifest') of a set of folders and tokenizer
+    # settings; unlike cacheKey it doesn't depend on the folder contents, so each
+    # folder set has one file of each kind, overwritten when its contents change
+    h = hashlib.sha1(f"{kind} {bool(stemming)} {bool(lower_case)}".encode())
+    if token_filter is not None:
+        h.update(token_filter.key().encode())
+    for d in dirs:
+        h.update(os.path.abspath(d).encode())
+    return h.hexdigest()
 
-    X_test0 = loadDir(dev_dir + '/pos/',stemming, lower_case,silently)
-    X_test1 = loadDir(dev_dir + '/neg/',stemming, lower_case,silently)
+def cacheKey(dirs,stemming,lower_case,token_filter=None):
+    # Fingerprint of the folder contents (names, sizes, mtimes) and the tokenizer
+    # flags, stored in the cache file's header; any change to these invalidates it
+    h = hashlib.sha1(f"{bool(stemming)} {bool(lower_case)}".encode())
+    if token_filter is not None:
+        h.update(token_filter.key().encode())
+    for d in dirs:
+        h.update(os.path.abspath(d).encode())
+        for f in listdir(d):
+            st = os.stat(d + f)
+            h.update(f"\0{f}\0{st.st_size}\0{st.st_mtime_ns}".encode())
+    return h.digest()
+
+def saveCache(path,corpus,counts,fingerprint=bytes(20)):
+    # Stores the EncodedCorpus of all folders (counts = documents per folder)
+    # as a vocabulary blob, the offsets array and the flat token-id array, under
+    # a 20-byte fingerprint of what it was built from
+    words = '\n'.join(corpus.vocab.words).encode()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, fingerprint, *counts, len(words), len(corpus.tokens)))
+        f.write(words)
+        corpus.offsets.tofile(f)
+        corpus.tokens.tofile(f)
+    os.replace(tmp, path)
+
+def loadCache(path,fingerprint=None):
+    # Returns (corpus, counts) from the cache file, or None if it is unusable or
+    # (when fingerprint is given) was saved under a different fingerprint
+    try:
+        with open(path, 'rb') as f:
+            magic, saved, *counts, num_bytes, num_tokens = CACHE_HEADER.unpack(f.read(CACHE_HEADER.size))
+            if magic != CACHE_MAGIC or (fingerprint is not None and saved != fingerprint):
+                return None
+            words = f.read(num_bytes).decode()
+            offsets = array('I')
+            offsets.fromfile(f, sum(counts) + 1)
+            tokens = array('I')
+            tokens.fromfile(f, num_tokens)
+    except (OSError, EOFError, struct.error, UnicodeDecodeError):
+        return None
+    vocab = Vocabulary(words.split('\n') if words else ())
+    return EncodedCorpus(vocab, tokens, offsets), counts
+
+def loadDirs(dirs,stemming,lower_case,silently=False,workers=1,outs=None,token_filter=None,packed=False,interned=False,
+             pack_dir=None):
+    # Loads each folder into the matching container of outs (several folders
+    # may share one EncodedCorpus) and returns outs and the number of documents
+    # read from each folder
+    outs = outs or [[] for d in dirs]
+    counts = []
+    if workers > 1:
+        # all folders are queued on one pool so train and dev load concurrently
+        with makePool(workers) as pool:
+            jobs = [submitDir(pool,d,stemming,lower_case,workers,token_filter,packed,pack_dir) for d in dirs]
+            for futures, out in zip(jobs, outs):
+                before = len(out)
+                collectDirs([futures],silently,[out],interned)
+                counts.append(len(out) - before)
+    else:
+        for d, out in zip(dirs, outs):
+            before = len(out)
+            loadDir(d,stemming,lower_case,silently,out=out,token_filter=token_filter,packed=packed,interned=interned,
+                    pack_dir=pack_dir)
+            counts.append(len(out) - before)
+    return outs, counts
+
+def load_dataset(train_dir, dev_dir, stemming=False, lower_case=False, silently=True, workers=1, cache_dir=None, encoded=False,
+                 token_filter=None, packed=False, interned=False):
+    # With encoded=True the train and dev sets are returned as EncodedCorpus
+    # objects sharing one Vocabulary instead of lists of lists of words.
+    # token_filter (a TokenFilter) drops words while the files are tokenized;
+    # packed reads each folder from its PackedDir (kept in cache_dir if given,
+    # else in PACK_DIR) and interned shares one str
+    # per distinct word across documents (see loadDir). Documents decoded from
+    # the cache or an EncodedCorpus share their Vocabulary's strings anyway
+
+    dirs = [train_dir + '/pos/', train_dir + '/neg/', dev_dir + '/pos/', dev_dir + '/neg/']
+    cached = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, folderKey('tokens',dirs,stemming,lower_case,token_filter) + '.bin')
+        fingerprint = cacheKey(dirs,stemming,lower_case,token_filter)
+        cached = loadCache(cache_path, fingerprint)
+        stems_path = os.path.join(cache_dir, 'stems.tsv')
+        if stemming and cached is None:
+            loadStemTable(stems_path)
+
+    splits, corpus = None, None
+    if cached is not None:
+        corpus, counts = cached
+    elif encoded:
+        # documents are encoded as they are read, so no folder is ever held as strings
+        corpus = EncodedCorpus()
+        splits, counts = loadDirs(dirs,stemming,lower_case,silently,workers,[corpus] * 4,token_filter,packed,
+                                  pack_dir=cache_dir)
+    else:
+        splits, counts = loadDirs(dirs,stemming,lower_case,silently,workers,token_filter=token_filter,packed=packed,
+                                  interned=interned,pack_dir=cache_dir)
+    if cache_dir is not None and cached is None:
+        if corpus is None:
+            corpus = EncodedCorpus()
+            for docs in splits:
+                corpus.extend(docs)
+        saveCache(cache_path, corpus, counts, fingerprint)
+        if stemming:
+            saveStemTable(stems_path)
+
+    num_train = counts[0] + counts[1]
+    Y = counts[0] * [1] + counts[1] * [0]
+    Y_test = counts[2] * [1] + counts[3] * [0]
+    if encoded:
+        return corpus[:num_train],Y,corpus[num_train:],Y_test
+    if splits is None:
+        docs = corpus.decode()
+        return docs[:num_train],Y,docs[num_train:],Y_test
+
+    X0, X1, X_test0, X_test1 = splits
+    X = X0 + X1
     X_test = X_test0 + X_test1
-    Y_test = len(X_test0) * [1] + len(X_test1) * [0]
 
     return X,Y,X_test,Y_test
+
+MANIFEST_HEADER = 'MP1MANIFEST2'
+
+def manifestLines(entries):
+    # The tab-separated (folder index, file name, size, mtime_ns, sha1) line of every
+    # document, and the SHA-1 of all of them: the fingerprint the manifest and its
+    # token cache are both saved under
+    lines = ['\t'.join(map(str, entry)) + '\n' for entry in entries]
+    h = hashlib.sha1()
+    for line in lines:
+        h.update(line.encode())
+    return lines, h.digest()
+
+def saveManifest(path,lines,fingerprint):
+    # Writes the manifestLines of every document, in corpus order, after a header
+    # holding their fingerprint
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(f"{MANIFEST_HEADER}\t{fingerprint.hex()}\n")
+        f.writelines(lines)
+    os.replace(tmp, path)
+
+def loadManifest(path):
+    # Returns {(folder index, file name): (size, mtime_ns, sha1, document index)} from
+    # saveManifest's file and its fingerprint, or None if it is missing or unreadable
+    try:
+        with open(path, encoding='utf-8') as f:
+            header, fingerprint = f.readline().rstrip('\n').split('\t')
+            if header != MANIFEST_HEADER:
+                return None
+            manifest = {}
+            for i, line in enumerate(f):
+                k, name, size, mtime, digest = line.rstrip('\n').split('\t')
+                manifest[int(k), name] = (int(size), int(mtime), digest, i)
+            return manifest, bytes.fromhex(fingerprint)
+    except (OSError, ValueError):
+        return None
+
+def refresh_dataset(train_dir, dev_dir, cache_dir, stemming=False, lower_case=False, encoded=False, token_filter=None):
+    """
+    load_dataset that only tokenizes what changed since the last call. A manifest in
+    cache_dir records the size, mtime and SHA-1 of every file next to its cached tokens;
+    files whose size and mtime match are not read at all, files whose content hash
+    matches are not tokenized again, and deleted files are dropped.
+    Returns train_set, train_labels, dev_set, dev_labels like load_dataset, then the train
+    and dev changes since the last call, each (added, added_labels, removed,
+    removed_labels): a changed file has its old document removed and its new one added,
+    and on the first call every document is added. With the train changes a model can be
+    updated instead of retrained (see naive_bayes.NaiveBayesModel.update).
+    """
+    dirs = [train_dir + '/pos/', train_dir + '/neg/', dev_dir + '/pos/', dev_dir + '/neg/']
+    key = folderKey('manifest',dirs,stemming,lower_case,token_filter)
+    manifest_path = os.path.join(cache_dir, key + '.tsv')
+    tokens_path = os.path.join(cache_dir, key + '.bin')
+    stems_path = os.path.join(cache_dir, 'stems.tsv')
+    # the tokens only go with a manifest saved under the same fingerprint, so a crash
+    # between the two writes below makes the next call start over
+    loaded = loadManifest(manifest_path)
+    cached = loaded and loadCache(tokens_path, loaded[1])
+    if cached is None:
+        old, cached = {}, (EncodedCorpus(), None)
+    else:
+        old = loaded[0]
+    old_corpus = cached[0]
+    if stemming:
+        loadStemTable(stems_path)
+
+    vocab = old_corpus.vocab
+    corpus = EncodedCorpus(vocab)
+    entries, counts, seen = [], [], set()
+    added = [EncodedCorpus(vocab) for d in dirs]
+    removed = [EncodedCorpus(vocab) for d in dirs]
+    for k, d in enumerate(dirs):
+        for f in listdir(d):
+            st = os.stat(d + f)
+            entry = old.get((k, f))
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+                digest, doc = entry[2], old_corpus[entry[3]]
+            else:
+                with open(d + f, 'rb') as review:
+                    data = review.read()
+                digest = hashlib.sha1(data).hexdigest()
+                if entry is not None and entry[2] == digest:
+                    doc = old_corpus[entry[3]]  # touched, not changed
+                else:
+                    doc = vocab.encode(loadText(data,stemming,lower_case,token_filter))
+                    added[k].appendIds(doc)
+                    if entry is not None:
+                        removed[k].appendIds(old_corpus[entry[3]])
+            seen.add((k, f))
+            corpus.appendIds(doc)
+            entries.append((k, f, st.st_size, st.st_mtime_ns, digest))
+        counts.append(len(entries) - sum(counts))
+    for (k, f), entry in old.items():
+        if (k, f) not in seen:
+            removed[k].appendIds(old_corpus[entry[3]])
+
+    lines, fingerprint = manifestLines(entries)
+    saveCache(tokens_path, corpus, counts, fingerprint)
+    saveManifest(manifest_path, lines, fingerprint)
+    if stemming:
+        saveStemTable(stems_path)
+
+    def split(corpora, k):
+        # Documents and labels of folders k (pos) and k + 1 (neg) as one split
+        docs = EncodedCorpus(vocab)
+        for doc in list(corpora[k]) + list(corpora[k + 1]):
+            docs.appendIds(doc)
+        labels = len(corpora[k]) * [1] + len(corpora[k + 1]) * [0]
+        return (docs if encoded else docs.decode()), labels
+
+    num_train = counts[0] + counts[1]
+    Y = counts[0] * [1] + counts[1] * [0]
+    Y_test = counts[2] * [1] + counts[3] * [0]
+    if encoded:
+        X, X_test = corpus[:num_train], corpus[num_train:]
+    else:
+        docs = corpus.decode()
+        X, X_test = docs[:num_train], docs[num_train:]
+    train_changes = split(added, 0) + split(removed, 0)
+    dev_changes = split(added, 2) + split(removed, 2)
+    return X,Y,X_test,Y_test,train_changes,dev_changes